@@ -1,55 +1,43 @@
 import flask
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, current_app, request, jsonify
 import psycopg2
-import bcrypt
 import jwt
 import datetime
+import time
 from functools import wraps
 import secrets
 from psycopg2.extras import RealDictCursor
-import json
+import background
+import config
+import db
+import hashing
+import instrumentation
+import revocation
+import serving
+import token_cache
 
-app = Flask(__name__)
-app.secret_key = 'test'
+bp = Blueprint('auth', __name__)
+instrumentation.register_gauges("db_pool", db.pool_metrics)
+instrumentation.register_gauges("token_cache", token_cache.cache.stats)
 
-# Load database configuration from db.json
-with open("db.json", "r") as file:
-    DATABASE_CONFIG = json.load(file)
 
+def create_app():
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    instrumentation.init_app(app, "auth")
+    serving.init_app(app)
+    app.register_blueprint(bp)
+    return app
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        dbname=DATABASE_CONFIG["dbname"],
-        user=DATABASE_CONFIG["user"],
-        password=DATABASE_CONFIG["password"],
-        host=DATABASE_CONFIG["host"],
-        port=DATABASE_CONFIG["port"]
-    )
-    return conn
-
-def create_tables():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS "USER" (
-        id SERIAL PRIMARY KEY,
-        email TEXT UNIQUE NOT NULL,
-        username TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS "SESSION" (
-        id SERIAL PRIMARY KEY,
-        user_id INTEGER NOT NULL,
-        session_token TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES "USER" (id)
-    )
-    """)
-    conn.commit()
-    conn.close()
+
+@bp.app_errorhandler(db.PoolTimeout)
+def pool_timeout(e):
+    return jsonify({'message': 'Service is busy, please retry.'}), 503, {'Retry-After': '1'}
+
+
+@bp.app_errorhandler(hashing.HashPoolSaturated)
+def hash_pool_saturated(e):
+    return jsonify({'message': 'Too many requests, please retry.'}), 429, {'Retry-After': str(config.HASH_RETRY_AFTER)}
 
 def token_required(f):
     @wraps(f)
@@ -58,26 +46,15 @@ def token_required(f):
         if not token:
             return jsonify({'message': 'Token is missing!'}), 401
 
-        try:
-            data = jwt.decode(token, app.secret_key, algorithms=["HS256"])
-            conn = get_db_connection()
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-            cursor.execute("SELECT * FROM \"USER\" WHERE id = %s", (data['user_id'],))
-            user = cursor.fetchone()
-            conn.close()
-
-            if not user:
-                return jsonify({'message': 'Invalid token!'}), 401
-        except jwt.ExpiredSignatureError:
-            return jsonify({'message': 'Token has expired!'}), 401
-        except Exception:
-            return jsonify({'message': 'Token is invalid!'}), 401
+        user, error = revocation.verify_token(token, current_app.secret_key)
+        if error:
+            return jsonify(error), 401
 
         return f(user, *args, **kwargs)
 
     return decorated
 
-@app.route('/register', methods=['POST'])
+@bp.route('/register', methods=['POST'])
 def register():
     data = request.get_json()
     email = data.get('email')
@@ -88,25 +65,51 @@ def register():
         return jsonify({'message': 'All fields are required!'}), 400
 
     # Hash the password and store it as a string
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    hashed_password = hashing.hash_password(password)
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO \"USER\" (email, username, password_hash) VALUES (%s, %s, %s)",
-            (email, username, hashed_password)
-        )
-        conn.commit()
-        conn.close()
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO \"USER\" (email, username, password_hash) VALUES (%s, %s, %s)",
+                (email, username, hashed_password)
+            )
+            conn.commit()
         return jsonify({'message': 'User registered successfully!'}), 201
     except psycopg2.IntegrityError:
-        conn.rollback()
-        conn.close()
+        # The pool rolls back the failed transaction when the connection is returned
         return jsonify({'message': 'Email or username already exists!'}), 400
 
 
-@app.route('/login', methods=['POST'])
+# Picks an empty slot first, then an expired one, then the oldest session,
+# and revokes the still-valid token it replaces. Returns the revoked jti.
+UPSERT_SESSION = """
+    WITH target AS (
+        SELECT s.slot, x.jti AS old_jti, x.expires_at AS old_expires_at
+        FROM generate_series(0, %(max_sessions)s - 1) AS s (slot)
+        LEFT JOIN "SESSION" x ON x.user_id = %(user_id)s AND x.slot = s.slot
+        ORDER BY x.id IS NOT NULL, x.expires_at > now(), x.created_at, s.slot
+        LIMIT 1
+    ), revoked AS (
+        INSERT INTO REVOKED_TOKENS (jti, expires_at)
+        SELECT old_jti, old_expires_at FROM target
+        WHERE old_jti IS NOT NULL AND old_expires_at > now()
+        ON CONFLICT (jti) DO NOTHING
+        RETURNING jti
+    ), upserted AS (
+        INSERT INTO "SESSION" (user_id, slot, session_token, jti, expires_at)
+        SELECT %(user_id)s, slot, %(token)s, %(jti)s, %(expires_at)s FROM target
+        ON CONFLICT (user_id, slot) DO UPDATE
+        SET session_token = EXCLUDED.session_token,
+            jti = EXCLUDED.jti,
+            expires_at = EXCLUDED.expires_at,
+            created_at = CURRENT_TIMESTAMP
+    )
+    SELECT jti FROM revoked
+"""
+
+
+@bp.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
     username = data.get('username')
@@ -115,42 +118,138 @@ def login():
     if not username or not password:
         return jsonify({'message': 'Username and password are required!'}), 400
 
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT * FROM \"USER\" WHERE username = %s", (username,))
-    user = cursor.fetchone()
+    with db.connection() as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("SELECT * FROM \"USER\" WHERE username = %s", (username,))
+        user = cursor.fetchone()
+
+    # Compare the hashed password correctly (without holding a pooled connection)
+    if not user or not hashing.check_password(password, user['password_hash']):
+        return jsonify({'message': 'Invalid username or password!'}), 401
 
-    # Compare the hashed password correctly
-    if user and bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
-        # Generate a new token
+    # Upgrade hashes made with a different BCRYPT_ROUNDS while we have the plaintext
+    new_hash = None
+    if hashing.needs_rehash(user['password_hash']):
+        try:
+            new_hash = hashing.hash_password(password)
+        except hashing.HashPoolSaturated:
+            pass  # try again on a later login rather than failing this one
+
+    # Generate a new token
+    expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=config.SESSION_LIFETIME)
+    jti = secrets.token_hex(16)
+    with instrumentation.span("jwt.encode"):
         token = jwt.encode({
             'user_id': user['id'],
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)
-        }, app.secret_key, algorithm="HS256")
+            'username': user['username'],
+            'jti': jti,
+            'exp': expires_at
+        }, current_app.secret_key, algorithm="HS256")
 
-        # Invalidate old tokens (optional: keep only one session per user)
-        cursor.execute("DELETE FROM \"SESSION\" WHERE user_id = %s", (user['id'],))
-
-        # Store the new token in the SESSION table
-        cursor.execute(
-            "INSERT INTO \"SESSION\" (user_id, session_token) VALUES (%s, %s)",
-            (user['id'], token)
-        )
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        # Serialize logins per user so two of them can't both replace the same slot
+        cursor.execute("SELECT 1 FROM \"USER\" WHERE id = %s FOR NO KEY UPDATE", (user['id'],))
+        if new_hash:
+            cursor.execute(
+                "UPDATE \"USER\" SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                (new_hash, user['id'], user['password_hash'])
+            )
+
+        # Store the new token in a free slot, or replace the user's oldest session
+        cursor.execute(UPSERT_SESSION, {
+            'user_id': user['id'],
+            'token': token,
+            'jti': jti,
+            'expires_at': expires_at,
+            'max_sessions': config.MAX_SESSIONS_PER_USER,
+        })
+        rotated_out = [row[0] for row in cursor.fetchall()]
         conn.commit()
-        conn.close()
 
-        return jsonify({'token': token}), 200
-    else:
-        conn.close()
-        return jsonify({'message': 'Invalid username or password!'}), 401
+    # Tokens from the rotated-out session must not keep hitting the cache
+    token_cache.cache.invalidate_user(user['id'])
+    for old_jti in rotated_out:
+        revocation.revoked.add(old_jti)
+
+    return jsonify({'token': token}), 200
 
 
+@bp.route('/logout', methods=['POST'])
+@token_required
+def logout(user):
+    """End the session of the presented token; other processes stop accepting it
+    within REVOCATION_REFRESH_INTERVAL (stateless) or TOKEN_CACHE_TTL seconds."""
+    token = request.headers.get('Authorization')
+    claims = jwt.decode(token, current_app.secret_key, algorithms=["HS256"])
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM \"SESSION\" WHERE session_token = %s", (token,))
+        if 'jti' in claims:
+            expires_at = datetime.datetime.fromtimestamp(claims['exp'], datetime.timezone.utc)
+            revocation.revoke(cursor, claims['jti'], expires_at)
+        conn.commit()
+
+    token_cache.cache.invalidate_user(user['id'])
+    if 'jti' in claims:
+        revocation.revoked.add(claims['jti'])
+    return jsonify({'message': 'Logged out.'}), 200
+
+
+
+def sweep_expired_sessions():
+    """Delete expired sessions and revocations in small batches, committing after each one.
+
+    SKIP LOCKED and a short lock_timeout keep the sweeper from ever waiting
+    on, or blocking, logins for long.
+    """
+    deleted = 0
+    while True:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SET LOCAL lock_timeout = '1s'")
+            cursor.execute("""
+                DELETE FROM "SESSION" WHERE id IN (
+                    SELECT id FROM "SESSION"
+                    WHERE expires_at < now()
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            """, (config.SESSION_SWEEP_BATCH,))
+            sessions = cursor.rowcount
+            cursor.execute("""
+                DELETE FROM REVOKED_TOKENS WHERE jti IN (
+                    SELECT jti FROM REVOKED_TOKENS
+                    WHERE expires_at < now()
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            """, (config.SESSION_SWEEP_BATCH,))
+            revocations = cursor.rowcount
+            conn.commit()
+        deleted += sessions + revocations
+        if max(sessions, revocations) < config.SESSION_SWEEP_BATCH:
+            return deleted
+        time.sleep(config.SESSION_SWEEP_PAUSE)
+
+
+@serving.on_worker_start
+def start_background_workers():
+    sweeper = background.PeriodicWorker(
+        "session-sweeper", config.SESSION_SWEEP_INTERVAL, sweep_expired_sessions
+    )
+    sweeper.start()
+    serving.on_worker_exit(sweeper.stop)
+
 
-@app.route('/protected', methods=['GET'])
+@bp.route('/protected', methods=['GET'])
 @token_required
 def protected(user):
     return jsonify({'message': f'Welcome, {user["username"]}!'}), 200
 
 if __name__ == '__main__':
-    create_tables()
-    app.run(host="0.0.0.0", port=5001, debug=False)
+    # Development server; production runs under gunicorn (see entry.sh)
+    import schema
+    schema.migrate()
+    serving.worker_started()
+    create_app().run(host="0.0.0.0", port=5001, debug=False)
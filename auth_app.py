@@ -4,82 +4,98 @@ import dash
 from dash import dcc, html, Input, Output, State
 import dash_uploader as du
 import requests
+from requests.adapters import HTTPAdapter
+import mimetypes
 import os
+import uuid
 from dash.dependencies import ALL
 
-# Configure Dash app
-app = dash.Dash(__name__)
-server = app.server  # For deploying later
-app.title = "File Management App"
-
-# Set up Dash Uploader
 UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-du.configure_upload(app, UPLOAD_FOLDER)
 
 # Base URLs for the APIs
 AUTH_URL = "http://127.0.0.1:5001"
 UPLOAD_URL = "http://127.0.0.1:5002"
 
-# User token
-token = None
-
-# Layout of the Dash app
-app.layout = html.Div(
-    [
-        html.H1("File Management System", style={"textAlign": "center"}),
-
-        html.Div(
-            [
-                html.H2("Register"),
-                dcc.Input(id="register-email", type="email", placeholder="Email", style={"marginRight": "10px"}),
-                dcc.Input(id="register-username", type="text", placeholder="Username", style={"marginRight": "10px"}),
-                dcc.Input(id="register-password", type="password", placeholder="Password"),
-                html.Button("Register", id="register-button", n_clicks=0),
-                html.Div(id="register-output", style={"marginTop": "10px", "color": "green"}),
-            ],
-            style={"marginBottom": "20px"},
-        ),
-
-        html.Div(
-            [
-                html.H2("Login"),
-                dcc.Input(id="login-username", type="text", placeholder="Username", style={"marginRight": "10px"}),
-                dcc.Input(id="login-password", type="password", placeholder="Password"),
-                html.Button("Login", id="login-button", n_clicks=0),
-                html.Div(id="login-output", style={"marginTop": "10px", "color": "blue"}),
-            ],
-            style={"marginBottom": "20px"},
-        ),
-
-        html.Div(
-            [
-                html.H2("Upload Files"),
-                du.Upload(
-                    id="file-uploader",
-                    text="Drag and Drop or Click to Upload",
-                    max_files=1,
-                    max_file_size=1024 * 5,  # 5 MB limit
-                ),
-                html.Div(id="upload-output", style={"marginTop": "10px", "color": "purple"}),
-            ],
-            style={"marginBottom": "20px"},
-        ),
-
-        html.Div(
-            [
-                html.H2("Uploaded Files"),
-                html.Button("List Files", id="list-files-button", n_clicks=0),
-                html.Div(id="files-list", style={"marginTop": "10px", "color": "brown"}),
-            ]
-        ),
-    ],
-    style={"width": "60%", "margin": "auto"},
+# Files fetched per "List Files" / "Load More" click
+FILES_PAGE_SIZE = 50
+
+# (connect, read) timeouts for calls to the APIs, in seconds
+API_TIMEOUT = (
+    float(os.environ.get("API_CONNECT_TIMEOUT", 3)),
+    float(os.environ.get("API_READ_TIMEOUT", 30)),
 )
 
+# One keep-alive connection pool per process, shared by all callbacks
+http = requests.Session()
+http.mount("http://", HTTPAdapter(pool_maxsize=int(os.environ.get("API_POOL_SIZE", 20))))
+
+def layout():
+    """Layout of the Dash app, built on every page load.
+
+    Each load gets its own dash_uploader upload_id, so files from different
+    browsers never share an UPLOAD_FOLDER directory.
+    """
+    return html.Div(
+        [
+            html.H1("File Management System", style={"textAlign": "center"}),
+
+            # Each browser tab keeps its own login, so any worker can serve any user
+            dcc.Store(id="auth-token", storage_type="session"),
+
+            html.Div(
+                [
+                    html.H2("Register"),
+                    dcc.Input(id="register-email", type="email", placeholder="Email", style={"marginRight": "10px"}),
+                    dcc.Input(id="register-username", type="text", placeholder="Username", style={"marginRight": "10px"}),
+                    dcc.Input(id="register-password", type="password", placeholder="Password"),
+                    html.Button("Register", id="register-button", n_clicks=0),
+                    html.Div(id="register-output", style={"marginTop": "10px", "color": "green"}),
+                ],
+                style={"marginBottom": "20px"},
+            ),
+
+            html.Div(
+                [
+                    html.H2("Login"),
+                    dcc.Input(id="login-username", type="text", placeholder="Username", style={"marginRight": "10px"}),
+                    dcc.Input(id="login-password", type="password", placeholder="Password"),
+                    html.Button("Login", id="login-button", n_clicks=0),
+                    html.Div(id="login-output", style={"marginTop": "10px", "color": "blue"}),
+                ],
+                style={"marginBottom": "20px"},
+            ),
+
+            html.Div(
+                [
+                    html.H2("Upload Files"),
+                    du.Upload(
+                        id="file-uploader",
+                        upload_id=str(uuid.uuid4()),
+                        text="Drag and Drop or Click to Upload",
+                        max_files=1,
+                        max_file_size=1024 * 5,  # 5 MB limit
+                    ),
+                    html.Div(id="upload-output", style={"marginTop": "10px", "color": "purple"}),
+                ],
+                style={"marginBottom": "20px"},
+            ),
+
+            html.Div(
+                [
+                    html.H2("Uploaded Files"),
+                    html.Button("List Files", id="list-files-button", n_clicks=0),
+                    html.Div(id="files-list", style={"marginTop": "10px", "color": "brown"}),
+                    html.Button("Load More", id="load-more-button", n_clicks=0, style={"display": "none"}),
+                    dcc.Store(id="files-cursor"),
+                ]
+            ),
+        ],
+        style={"width": "60%", "margin": "auto"},
+    )
+
 
 # Callback for registering a new user
-@app.callback(
+@dash.callback(
     Output("register-output", "children"),
     Input("register-button", "n_clicks"),
     State("register-email", "value"),
@@ -90,7 +106,10 @@ def register_user(n_clicks, email, username, password):
     if n_clicks > 0:
         url = f"{AUTH_URL}/register"
         payload = {"email": email, "username": username, "password": password}
-        response = requests.post(url, json=payload)
+        try:
+            response = http.post(url, json=payload, timeout=API_TIMEOUT)
+        except requests.RequestException as e:
+            return f"Registration failed: {str(e)}."
         if response.status_code == 201:
             return "Registration successful!"
         else:
@@ -99,104 +118,200 @@ def register_user(n_clicks, email, username, password):
 
 
 # Callback for logging in
-@app.callback(
+@dash.callback(
     Output("login-output", "children"),
+    Output("auth-token", "data"),
     Input("login-button", "n_clicks"),
     State("login-username", "value"),
     State("login-password", "value"),
+    prevent_initial_call=True,
 )
 def login_user(n_clicks, username, password):
-    global token
-    if n_clicks > 0:
-        url = f"{AUTH_URL}/login"
-        payload = {"username": username, "password": password}
-        response = requests.post(url, json=payload)
-        if response.status_code == 200:
-            token = response.json().get("token")
-            return "Login successful!"
-        else:
-            return f"Login failed: {response.json().get('message', 'Unknown error')}."
-    return ""
+    url = f"{AUTH_URL}/login"
+    payload = {"username": username, "password": password}
+    try:
+        response = http.post(url, json=payload, timeout=API_TIMEOUT)
+    except requests.RequestException as e:
+        return f"Login failed: {str(e)}.", dash.no_update
+    if response.status_code == 200:
+        return "Login successful!", response.json().get("token")
+    else:
+        return f"Login failed: {response.json().get('message', 'Unknown error')}.", dash.no_update
 
 
-@du.callback(
-    output=Output("upload-output", "children"),
-    id="file-uploader",
+@dash.callback(
+    Output("upload-output", "children"),
+    Input("file-uploader", "isCompleted"),
+    State("file-uploader", "fileNames"),
+    State("file-uploader", "upload_id"),
+    State("auth-token", "data"),
+    background=True,
+    running=[(Output("upload-output", "children"), "Uploading...", "")],
+    prevent_initial_call=True,
 )
-def upload_file(file_paths):
-    """Handle the uploaded file(s) and send them to the API."""
-    global token
-    if not token:
-        return "Please log in to upload files."
+def upload_file(is_completed, file_names, upload_id, token):
+    """Forward the file dash_uploader received to the upload service, then delete it.
 
-    if not file_paths or len(file_paths) == 0:
+    The local copy is sent as a raw request body, which requests streams
+    from disk instead of building a multipart body in memory, and is
+    removed whatever the outcome, so uploads/ only ever holds files that
+    are still being received or forwarded. Its directory goes too once it
+    is empty; the page may still be uploading other files into it.
+    """
+    if not is_completed:
+        return dash.no_update
+    if not file_names:
         return "No file provided."
 
-    # Extract the first file path from the list
-    file_path = file_paths[0]  # Dash Uploader always provides a list
+    # Both values come from the browser, so nothing outside UPLOAD_FOLDER may be read or removed
+    upload_dir, file_path = uploaded_path(upload_id, file_names[0])
+    if not file_path:
+        return "Invalid upload."
+    file_name = os.path.basename(file_path)
 
     try:
-        url = f"{UPLOAD_URL}/upload?token={token}"
+        if not token:
+            return "Please log in to upload files."
+
         with open(file_path, "rb") as file:
-            files = {"file": (os.path.basename(file_path), file, "text/plain")}
-            response = requests.post(url, files=files)
+            response = http.post(
+                f"{UPLOAD_URL}/upload",
+                params={"token": token, "name": file_name},
+                data=file,
+                headers={"Content-Type": mimetypes.guess_type(file_name)[0] or "text/plain"},
+                timeout=API_TIMEOUT,
+            )
 
         if response.status_code == 201:
-            return f"File uploaded successfully: {os.path.basename(file_path)}."
+            return f"File uploaded successfully: {file_name}."
         else:
             return f"File upload failed: {response.json().get('message', 'Unknown error')}."
     except Exception as e:
         return f"An error occurred during file upload: {str(e)}."
+    finally:
+        try:
+            os.remove(file_path)
+            os.rmdir(upload_dir)
+        except OSError:
+            pass
+
+
+def uploaded_path(upload_id, file_name):
+    """(directory, file) dash_uploader stored an upload at, or (None, None) if they are not valid.
+
+    dash_uploader keeps each upload in UPLOAD_FOLDER/<upload_id>/ with a
+    UUID upload_id; anything else, and any path that resolves outside
+    UPLOAD_FOLDER, is rejected.
+    """
+    try:
+        if str(uuid.UUID(upload_id)) != upload_id.lower():
+            return None, None
+    except (TypeError, ValueError, AttributeError):
+        return None, None
+    name = os.path.basename(file_name or "")
+    if not name or name in (".", ".."):
+        return None, None
+    root = os.path.realpath(UPLOAD_FOLDER)
+    upload_dir = os.path.realpath(os.path.join(root, upload_id))
+    file_path = os.path.realpath(os.path.join(upload_dir, name))
+    if upload_dir == root or os.path.commonpath([root, upload_dir, file_path]) != root \
+            or os.path.dirname(file_path) != upload_dir:
+        return None, None
+    return upload_dir, file_path
 
 
-@app.callback(
-    Output("files-list", "children"),
+def file_item(file):
+    return html.Li(
+        [
+            f"{file['file_name']} (Uploaded: {file['uploaded_at']}) ",
+            html.Button("Delete", id={"type": "delete-button", "index": file["id"]}),
+        ]
+    )
+
+
+@dash.callback(
+    [Output("files-list", "children"),
+     Output("files-cursor", "data"),
+     Output("load-more-button", "style")],
     [Input("list-files-button", "n_clicks"),
+     Input("load-more-button", "n_clicks"),
      Input({"type": "delete-button", "index": ALL}, "n_clicks")],
+    [State("files-cursor", "data"),
+     State("auth-token", "data")],
+    background=True,
+    running=[(Output("list-files-button", "disabled"), True, False)],
     prevent_initial_call=True,
 )
-def list_or_delete_files(n_clicks_list, n_clicks_delete):
-    global token
+def list_or_delete_files(n_clicks_list, n_clicks_more, n_clicks_delete, cursor, token):
     ctx = dash.callback_context
+    hidden = {"display": "none"}
     if not token:
-        return [html.Li("Please log in to view or manage files.")]
+        return [html.Li("Please log in to view or manage files.")], None, hidden
 
     # Detect which button was clicked
     if ctx.triggered_id and isinstance(ctx.triggered_id, dict) and ctx.triggered_id["type"] == "delete-button":
         file_id = ctx.triggered_id["index"]
         url = f"{UPLOAD_URL}/delete/{file_id}?token={token}"
         try:
-            response = requests.delete(url)
+            response = http.delete(url, timeout=API_TIMEOUT)
             if response.status_code == 200:
-                return [html.Li(f"File deleted successfully!")]
+                return [html.Li(f"File deleted successfully!")], None, hidden
             else:
-                return [html.Li(f"Failed to delete file: {response.json().get('message', 'Unknown error')}")]
+                return [html.Li(f"Failed to delete file: {response.json().get('message', 'Unknown error')}")], None, hidden
         except Exception as e:
-            return [html.Li(f"An error occurred: {str(e)}")]
+            return [html.Li(f"An error occurred: {str(e)}")], None, hidden
 
-    # List files
-    url = f"{UPLOAD_URL}/files?token={token}"
+    # List files one page at a time; "Load More" appends the next page in the
+    # browser, so the items already shown are never sent back and forth
+    load_more = ctx.triggered_id == "load-more-button" and cursor
+    params = {"token": token, "limit": FILES_PAGE_SIZE}
+    if load_more:
+        params["cursor"] = cursor
     try:
-        response = requests.get(url)
+        response = http.get(f"{UPLOAD_URL}/files", params=params, timeout=API_TIMEOUT)
         if response.status_code == 200:
-            files = response.json().get("files", [])
-            if not files:
-                return [html.Li("No files uploaded yet.")]
-            return [
-                html.Li(
-                    [
-                        f"{file['file_name']} (Uploaded: {file['uploaded_at']}) ",
-                        html.Button("Delete", id={"type": "delete-button", "index": file["id"]}),
-                    ]
-                )
-                for file in files
-            ]
+            page = response.json()
+            files = page.get("files", [])
+            items = [file_item(file) for file in files]
+            if load_more:
+                patch = dash.Patch()
+                patch.extend(items)
+                items = patch
+            elif not files:
+                return [html.Li("No files uploaded yet.")], None, hidden
+            next_cursor = page.get("next_cursor")
+            return items, next_cursor, ({"marginTop": "10px"} if next_cursor else hidden)
         else:
             error_message = response.json().get("error", "Unknown error")
-            return [html.Li(f"Failed to retrieve files: {error_message}")]
+            return [html.Li(f"Failed to retrieve files: {error_message}")], None, hidden
     except Exception as e:
-        return [html.Li(f"An error occurred: {str(e)}")]
+        return [html.Li(f"An error occurred: {str(e)}")], None, hidden
+
+
+def create_app():
+    import diskcache
+
+    # Uploads and listings run as background callbacks so a slow backend never
+    # ties up a web worker. The cache directory must be shared by every worker.
+    background_callback_manager = dash.DiskcacheManager(
+        diskcache.Cache(os.environ.get("DASH_CACHE_DIR", "dash-cache"))
+    )
+    app = dash.Dash(__name__, background_callback_manager=background_callback_manager)
+    app.title = "File Management App"
+    app.layout = layout
+
+    # Set up Dash Uploader
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    du.configure_upload(app, UPLOAD_FOLDER)
+    return app
+
+
+def create_server():
+    """WSGI entry point for gunicorn."""
+    return create_app().server
 
 
 if __name__ == "__main__":
-    app.run_server(port="9000", debug=True)
+    # Development server; production runs auth_app:create_server() under gunicorn (see entry.sh)
+    app = create_app()
+    app.run_server(port="9000", debug=os.environ.get("DASH_DEBUG") == "1")
@@ -1,10 +1,60 @@
+import mimetypes
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values`` (which must be sorted)."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
 
 class APIClient:
-    def __init__(self, base_url):
+    """Client for the auth (5001) and upload (5002) services.
+
+    All requests go through one pooled ``requests.Session``, so connections
+    are kept alive and reused. Idempotent requests (GET, DELETE, ...) that
+    fail to connect or are answered with 503 (pool exhausted) or 429 are
+    retried up to ``retries`` times with exponential backoff, honouring
+    Retry-After. POSTs are never retried, since streamed bodies cannot be
+    replayed.
+    ``timeout`` is passed to every request, either as one number or as a
+    ``(connect, read)`` pair.
+    """
+
+    def __init__(self, base_url, upload_url=None, pool_size=10, retries=3, timeout=(5, 60)):
         self.base_url = base_url
+        self.upload_url = upload_url or base_url.replace("5001", "5002")
+        self.timeout = timeout
         self.token = None
 
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.2,
+            status_forcelist=(429, 503),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def register_user(self, email, username, password):
         url = f"{self.base_url}/register"
         payload = {
@@ -12,7 +62,7 @@ class APIClient:
             "username": username,
             "password": password
         }
-        response = requests.post(url, json=payload)
+        response = self.session.post(url, json=payload, timeout=self.timeout)
         print("Register Response:", response.status_code, response.json())
         return response
 
@@ -22,7 +72,7 @@ class APIClient:
             "username": username,
             "password": password
         }
-        response = requests.post(url, json=payload)
+        response = self.session.post(url, json=payload, timeout=self.timeout)
         print("Login Response:", response.status_code, response.json())
         if response.status_code == 200:
             self.token = response.json().get("token")
@@ -37,27 +87,83 @@ class APIClient:
         headers = {
             "Authorization": self.token
         }
-        response = requests.get(url, headers=headers)
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
         print("Protected Endpoint Response:", response.status_code, response.json())
         return response
-    def upload_file(self, file_path):
+
+    def _upload(self, file_path, file_type=None):
+        """POST one file as a raw body, streamed from disk rather than buffered."""
+        file_type = file_type or mimetypes.guess_type(file_path)[0] or "text/plain"
+        with open(file_path, "rb") as file:
+            return self.session.post(
+                f"{self.upload_url}/upload",
+                params={"token": self.token, "name": os.path.basename(file_path)},
+                data=file,
+                headers={"Content-Type": file_type},
+                timeout=self.timeout,
+            )
+
+    def upload_file(self, file_path, file_type=None):
         """Upload a file to the server."""
         if not self.token:
             print("No token available. Please log in first.")
             return None
 
-        url = f"{self.base_url.replace("5001","5002")}/upload?token={self.token}"
-        with open(file_path, "rb") as file:
-            files = {"file": (file_path, file, "text/plain")}  # Set MIME type explicitly
-            response = requests.post(url, files=files)
-        
+        response = self._upload(file_path, file_type)
         print("File Upload Response:", response.status_code, response.json())
         return response
 
+    def upload_many(self, paths, concurrency=4):
+        """Upload ``paths`` from ``concurrency`` threads sharing the session's pool.
+
+        Returns a dict with one result per path (in input order) holding its
+        status, response body or error, and latency in seconds, plus totals
+        and latency percentiles for the whole run. Keep ``concurrency`` at or
+        below ``pool_size`` or the extra threads open throwaway connections.
+        """
+        if not self.token:
+            print("No token available. Please log in first.")
+            return None
+
+        def upload(path):
+            started = time.perf_counter()
+            result = {"path": path}
+            try:
+                response = self._upload(path)
+                result["status"] = response.status_code
+                result["ok"] = response.status_code == 201
+                result["response"] = response.json()
+            except (requests.RequestException, OSError, ValueError) as e:
+                result["ok"] = False
+                result["error"] = str(e)
+            result["latency"] = time.perf_counter() - started
+            return result
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="upload") as executor:
+            results = list(executor.map(upload, paths))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(result["latency"] for result in results)
+        succeeded = sum(1 for result in results if result["ok"])
+        return {
+            "results": results,
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "elapsed": elapsed,
+            "throughput": len(results) / elapsed if elapsed else 0.0,
+            "latency": {
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None,
+            },
+        }
+
 # Main function to demonstrate usage
 def main():
-    base_url = "http://127.0.0.1:5002"  # Base URL for file upload app
-    client = APIClient(base_url)
+    base_url = "http://127.0.0.1:5001"  # Base URL for the auth app
+    client = APIClient(base_url, upload_url="http://127.0.0.1:5002")
 
     # Sample user details
     email = "test@test.com"
@@ -80,6 +186,13 @@ def main():
         f.write("Hello, world!")
     client.upload_file(file_path)
 
+    # Step 5: Upload several files concurrently over the same connection pool
+    summary = client.upload_many([file_path] * 8, concurrency=4)
+    print("Batch Upload:", summary["succeeded"], "succeeded,", summary["failed"], "failed,",
+          f"p50 {summary['latency']['p50'] * 1000:.1f} ms")
+
+    client.close()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,53 +1,51 @@
 import flask
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, send_file
 from functools import wraps
+from werkzeug.http import http_date
 import psycopg2
-from psycopg2.extras import RealDictCursor
-import jwt
+from psycopg2.extras import RealDictCursor, execute_values
+import contextlib
+import mimetypes
 import os
-import json
+import tarfile
+import zipfile
+from urllib.parse import quote
+import compression
+import config
+import content
+import db
+import file_api
+import instrumentation
+import quota
+import reclaimer  # only for its serving.on_worker_start hook, which runs the blob reclaimer
+import revocation
+import serving
+import storage
+import token_cache
 
-app = Flask(__name__)
-app.secret_key = 'test'
+# Leave room for multipart framing; each file is capped at UPLOAD_MAX_SIZE while streaming
+MULTIPART_OVERHEAD = 64 * 1024
 
+bp = Blueprint('upload', __name__)
+instrumentation.register_gauges("db_pool", db.pool_metrics)
+instrumentation.register_gauges("token_cache", token_cache.cache.stats)
+instrumentation.register_gauges("compression", compression.stats.stats)
 
 
-# Load database configuration from db.json
-with open("db.json", "r") as file:
-    DATABASE_CONFIG = json.load(file)
+def create_app():
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.config['MAX_CONTENT_LENGTH'] = max(config.UPLOAD_MAX_SIZE, config.UPLOAD_BATCH_MAX_SIZE) + MULTIPART_OVERHEAD
+    instrumentation.init_app(app, "upload")
+    serving.init_app(app)
+    app.register_blueprint(bp)
+    return app
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        dbname=DATABASE_CONFIG["dbname"],
-        user=DATABASE_CONFIG["user"],
-        password=DATABASE_CONFIG["password"],
-        host=DATABASE_CONFIG["host"],
-        port=DATABASE_CONFIG["port"]
-    )
-    return conn
 
-def initialize_database():
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS FILES (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                file_name TEXT NOT NULL,
-                file_type TEXT NOT NULL,
-                file_data BYTEA NOT NULL,
-                uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-        conn.close()
-        print("Database initialized successfully.")
-    except psycopg2.Error as e:
-        print(f"Failed to initialize database: {e}")
-        if conn:
-            conn.rollback()
-        conn.close()
+@bp.app_errorhandler(db.PoolTimeout)
+def pool_timeout(e):
+    return jsonify({"message": "Service is busy, please retry."}), 503, {"Retry-After": "1"}
+
 
 def token_required(f):
     @wraps(f)
@@ -56,111 +54,571 @@ def token_required(f):
         if not token:
             return jsonify({"message": "Token is missing!"}), 401
 
-        try:
-            decoded_data = jwt.decode(token, app.secret_key, algorithms=["HS256"])
-            conn = get_db_connection()
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-            cursor.execute("SELECT * FROM \"USER\" WHERE id = %s", (decoded_data['user_id'],))
-            user = cursor.fetchone()
-            conn.close()
-
-            if not user:
-                return jsonify({"message": "Invalid token!"}), 401
-        except jwt.ExpiredSignatureError:
-            return jsonify({"message": "Token has expired!"}), 401
-        except jwt.InvalidTokenError as e:
-            return jsonify({"message": "Token is invalid!", "error": str(e)}), 401
+        user, error = revocation.verify_token(token, current_app.secret_key)
+        if error:
+            return jsonify(error), 401
 
         return f(user, *args, **kwargs)
     return decorated
 
-@app.route('/upload', methods=['POST'])
+@bp.route('/upload', methods=['POST'])
 @token_required
 def upload_file(user):
-    if 'file' not in request.files:
-        return jsonify({"message": "No file provided!"}), 400
+    """Store an upload sent either as multipart 'file' or as the raw request body.
 
-    uploaded_file = request.files['file']
-    file_name = uploaded_file.filename
-    file_type = uploaded_file.content_type
-    allowed_types = ["application/pdf", "text/plain", "text/csv"]
+    Raw uploads take the file name from the 'name' query parameter (or the
+    X-File-Name header) and are read straight off the socket. Either way the
+    body is staged in a temporary file while its SHA-256 is computed and its
+    first bytes are kept, so memory use does not depend on the file size,
+    the stored type is sniffed from the content (the declared one is only a
+    hint) and content that is already stored becomes a metadata-only
+    insert. CSV files are queued for indexing by content.start_indexer().
+    With a quota configured, the body is refused before it is read if it
+    cannot fit, and reading stops as soon as it no longer does.
+    """
+    if request.content_length is not None and request.content_length > config.UPLOAD_MAX_SIZE + MULTIPART_OVERHEAD:
+        return jsonify({"message": "File is too large!"}), 413
 
-    if file_type not in allowed_types:
-        return jsonify({"message": f"Invalid file type! Only .pdf, .txt, and .csv are allowed."}), 400
+    # Before request.files, which reads the whole multipart body
+    bytes_left, files_left = quota_left(user)
+    if files_left == 0 or (bytes_left is not None and request.content_length is not None
+                           and request.content_length > bytes_left + MULTIPART_OVERHEAD):
+        return jsonify({"message": "Storage quota exceeded!"}), 413
+    max_size = config.UPLOAD_MAX_SIZE if bytes_left is None else min(config.UPLOAD_MAX_SIZE, bytes_left)
 
-    # Read the file content
-    file_data = uploaded_file.read()
+    if request.mimetype == 'multipart/form-data':
+        if 'file' not in request.files:
+            return jsonify({"message": "No file provided!"}), 400
+        uploaded_file = request.files['file']
+        file_name = uploaded_file.filename
+        file_type = uploaded_file.content_type
+        stream = uploaded_file.stream
+    else:
+        file_name = request.args.get('name') or request.headers.get('X-File-Name')
+        file_type = request.mimetype
+        stream = request.stream
+        if not file_name:
+            return jsonify({"message": "No file provided!"}), 400
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO FILES (user_id, file_name, file_type, file_data)
-            VALUES (%s, %s, %s, %s)
-        """, (user['id'], file_name, file_type, psycopg2.Binary(file_data)))
-        conn.commit()
-        conn.close()
-        return jsonify({"message": f"File '{file_name}' uploaded successfully!"}), 201
-    except Exception as e:
-        conn.rollback()
-        conn.close()
+        # Read the body before borrowing a connection so slow clients don't hold one
+        with storage.spool(stream, config.UPLOAD_CHUNK_SIZE, max_size) as spooled:
+            # The declared type is only a hint; what is stored is what the content is
+            file_type = content.sniff_type(spooled.head, file_name, file_type)
+            if file_type not in file_api.ALLOWED_TYPES:
+                return jsonify({"message": f"Invalid file type! Only .pdf, .txt, and .csv are allowed."}), 400
+            compress(spooled, file_type)
+
+            with db.connection() as conn:
+                cursor = conn.cursor()
+                written = storage.store_blob(conn, spooled, config.UPLOAD_CHUNK_SIZE)
+                try:
+                    cursor.execute("""
+                        INSERT INTO FILES (user_id, file_name, file_type, file_size, blob_sha256)
+                        VALUES (%s, %s, %s, %s, %s)
+                        RETURNING id
+                    """, (user['id'], file_name, file_type, spooled.size, spooled.sha256))
+                    file_id = cursor.fetchone()[0]
+                    if file_type == 'text/csv':
+                        content.queue_index(cursor, spooled.sha256)
+                    # Last, so the usage row is only locked for the commit; this is the
+                    # authoritative check, quota_left() above was only optimistic
+                    quota.charge(cursor, user['id'], spooled.size)
+                    conn.commit()
+                except BaseException:
+                    # Still holding the BLOBS row lock, so no other upload can be using this copy
+                    if written:
+                        storage.remove_file(written)
+                    raise
+        return jsonify({
+            "message": f"File '{file_name}' uploaded successfully!",
+            "id": file_id,
+            "file_type": file_type,
+            "size": spooled.size,
+            "sha256": spooled.sha256,
+        }), 201
+    except storage.FileTooLarge:
+        if max_size < config.UPLOAD_MAX_SIZE:
+            return jsonify({"message": "Storage quota exceeded!"}), 413
+        return jsonify({"message": "File is too large!"}), 413
+    except quota.QuotaExceeded:
+        return jsonify({"message": "Storage quota exceeded!"}), 413
+    except psycopg2.Error as e:
         return jsonify({"message": "Failed to upload file.", "error": str(e)}), 500
-@app.route('/files', methods=['GET'])
+
+
+def quota_left(user):
+    """Bytes and files the user may still upload, each None when unlimited."""
+    if not quota.enabled():
+        return None, None
+    with db.connection() as conn:
+        return quota.available(conn.cursor(), user['id'])
+
+
+def compress(spooled, file_type):
+    """Compress staged content if STORAGE_COMPRESSION applies to ``file_type``."""
+    codec = compression.codec_for(file_type)
+    if codec:
+        with instrumentation.span("compress"):
+            spooled.compress(codec, config.COMPRESSION_LEVEL)
+
+
+class BatchTooLarge(Exception):
+    """Raised when a batch holds more than UPLOAD_BATCH_MAX_FILES files."""
+
+
+def batch_entries(stack):
+    """Yield ``(file_name, file_type, stream)`` for every file in a batch request.
+
+    Accepts multipart 'files' (or repeated 'file') parts, a tar stream
+    (optionally compressed) or a zip archive. Archive member types are
+    guessed from their names. Each stream must be consumed before the next
+    entry is requested, since tar members are read straight off the socket.
+    """
+    if request.mimetype == 'multipart/form-data':
+        for uploaded_file in request.files.getlist('files') + request.files.getlist('file'):
+            yield uploaded_file.filename, uploaded_file.content_type, uploaded_file.stream
+    elif request.mimetype in ('application/x-tar', 'application/gzip', 'application/x-gzip'):
+        archive = stack.enter_context(tarfile.open(fileobj=request.stream, mode='r|*'))
+        for member in archive:
+            if member.isfile():
+                yield member.name, mimetypes.guess_type(member.name)[0], archive.extractfile(member)
+    elif request.mimetype in ('application/zip', 'application/x-zip-compressed'):
+        # The zip directory is at the end, so the archive has to be staged first
+        spooled = stack.enter_context(
+            storage.spool(request.stream, config.UPLOAD_CHUNK_SIZE, config.UPLOAD_BATCH_MAX_SIZE)
+        )
+        archive = stack.enter_context(zipfile.ZipFile(spooled.path))
+        for info in archive.infolist():
+            if not info.is_dir():
+                with archive.open(info) as member:
+                    yield info.filename, mimetypes.guess_type(info.filename)[0], member
+
+
+def spool_batch(stack):
+    """Stage every file of a batch request, validating each one on its own.
+
+    Returns a list with one result dict per file; accepted files carry their
+    SpooledUpload under 'spooled', rejected ones an 'error' message. Raises
+    FileTooLarge once the staged files add up to more than
+    UPLOAD_BATCH_MAX_SIZE, which for archives is counted after
+    decompression.
+    """
+    results = []
+    staged = 0
+    for file_name, file_type, stream in batch_entries(stack):
+        if len(results) >= config.UPLOAD_BATCH_MAX_FILES:
+            raise BatchTooLarge()
+        result = {"file_name": file_name, "file_type": file_type}
+        results.append(result)
+        if not file_name:
+            result["error"] = "No file name provided!"
+            continue
+        batch_left = config.UPLOAD_BATCH_MAX_SIZE - staged
+        try:
+            spooled = stack.enter_context(
+                storage.spool(stream, config.UPLOAD_CHUNK_SIZE, min(config.UPLOAD_MAX_SIZE, batch_left))
+            )
+        except storage.FileTooLarge:
+            if batch_left < config.UPLOAD_MAX_SIZE:
+                raise
+            result["error"] = "File is too large!"
+            continue
+        staged += spooled.size
+        result["file_type"] = content.sniff_type(spooled.head, file_name, file_type)
+        if result["file_type"] not in file_api.ALLOWED_TYPES:
+            result["error"] = "Invalid file type! Only .pdf, .txt, and .csv are allowed."
+        else:
+            compress(spooled, result["file_type"])
+            result["spooled"] = spooled
+    return results
+
+
+def store_batch(user, results):
+    """Store the accepted files of a batch in one transaction.
+
+    Blob references are taken one file at a time inside savepoints, so a
+    failure only rejects that file, then every FILES row is written with a
+    single multi-row INSERT and the whole batch is committed once. Files
+    are admitted in request order while they fit in the user's quota; the
+    rest are rejected. The quota is charged just before the commit, so the
+    usage row is locked only briefly; raises QuotaExceeded if concurrent
+    uploads used up the room meanwhile.
+    """
+    accepted = [result for result in results if "spooled" in result]
+    written = []
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if quota.enabled():
+                bytes_left, files_left = quota.available(cursor, user['id'])
+                admitted = []
+                for result in accepted:
+                    size = result["spooled"].size
+                    if (bytes_left is not None and size > bytes_left) or files_left == 0:
+                        result["error"] = "Storage quota exceeded!"
+                        continue
+                    if bytes_left is not None:
+                        bytes_left -= size
+                    if files_left is not None:
+                        files_left -= 1
+                    admitted.append(result)
+                accepted = admitted
+
+            # Take BLOBS row locks in a fixed order so concurrent batches cannot deadlock
+            stored = []
+            for result in sorted(accepted, key=lambda result: result["spooled"].sha256):
+                cursor.execute("SAVEPOINT store_blob")
+                try:
+                    path = storage.store_blob(conn, result["spooled"], config.UPLOAD_CHUNK_SIZE)
+                except psycopg2.Error as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT store_blob")
+                    result["error"] = "Failed to upload file."
+                    result["detail"] = str(e)
+                    continue
+                cursor.execute("RELEASE SAVEPOINT store_blob")
+                if path:
+                    written.append(path)
+                stored.append(result)
+
+            if stored:
+                position = {id(result): i for i, result in enumerate(accepted)}
+                stored.sort(key=lambda result: position[id(result)])
+                rows = execute_values(cursor, """
+                    INSERT INTO FILES (user_id, file_name, file_type, file_size, blob_sha256)
+                    VALUES %s
+                    RETURNING id
+                """, [
+                    (user['id'], result["file_name"], result["file_type"],
+                     result["spooled"].size, result["spooled"].sha256)
+                    for result in stored
+                ], page_size=len(stored), fetch=True)
+                # Postgres returns the ids of a multi-row VALUES insert in input order
+                for result, (file_id,) in zip(stored, rows):
+                    result["id"] = file_id
+                csvs = sorted({result["spooled"].sha256 for result in stored if result["file_type"] == 'text/csv'})
+                if csvs:
+                    execute_values(cursor, """
+                        INSERT INTO BLOB_INDEX (sha256) VALUES %s ON CONFLICT (sha256) DO NOTHING
+                    """, [(sha256,) for sha256 in csvs], page_size=len(csvs))
+                quota.charge(cursor, user['id'], sum(result["spooled"].size for result in stored), len(stored))
+            conn.commit()
+        except BaseException:
+            # Still holding the BLOBS row locks, so no other upload can be using these copies
+            for path in written:
+                storage.remove_file(path)
+            raise
+
+
+@bp.route('/upload/batch', methods=['POST'])
+@token_required
+def upload_batch(user):
+    """Store many files from one request and report the outcome of each.
+
+    The body is either multipart/form-data with one 'files' part per file,
+    or a tar (application/x-tar, optionally gzip-compressed) or zip
+    (application/zip) archive. Rejected files are listed with an 'error'
+    and do not prevent the rest of the batch from being stored. Responds
+    201 when every file was stored, 207 when only some were and 400 when
+    none were.
+    """
+    if request.content_length is not None and request.content_length > config.UPLOAD_BATCH_MAX_SIZE + MULTIPART_OVERHEAD:
+        return jsonify({"message": "Batch is too large!"}), 413
+    bytes_left, files_left = quota_left(user)
+    if files_left == 0 or (bytes_left is not None and request.content_length is not None
+                           and request.content_length > bytes_left + MULTIPART_OVERHEAD):
+        return jsonify({"message": "Storage quota exceeded!"}), 413
+
+    try:
+        with contextlib.ExitStack() as stack:
+            results = spool_batch(stack)
+            if not results:
+                return jsonify({"message": "No files provided!"}), 400
+            store_batch(user, results)
+    except BatchTooLarge:
+        return jsonify({"message": f"Too many files! At most {config.UPLOAD_BATCH_MAX_FILES} are allowed per batch."}), 413
+    except storage.FileTooLarge:
+        return jsonify({"message": "Batch is too large!"}), 413
+    except quota.QuotaExceeded:
+        return jsonify({"message": "Storage quota exceeded!"}), 413
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        return jsonify({"message": "Invalid archive.", "error": str(e)}), 400
+    except psycopg2.Error as e:
+        return jsonify({"message": "Failed to upload files.", "error": str(e)}), 500
+
+    files = []
+    for result in results:
+        spooled = result.pop("spooled", None)
+        if "id" in result:
+            result.update({"size": spooled.size, "sha256": spooled.sha256})
+        files.append(result)
+    uploaded = sum(1 for result in files if "id" in result)
+    status = 201 if uploaded == len(files) else 207 if uploaded else 400
+    return jsonify({
+        "message": f"Uploaded {uploaded} of {len(files)} files.",
+        "uploaded": uploaded,
+        "failed": len(files) - uploaded,
+        "files": files,
+    }), status
+
+
+@bp.route('/files', methods=['GET'])
 @token_required
 def list_files(user):
-    """List all files uploaded by the authenticated user."""
+    """List the authenticated user's files, newest first, one page at a time.
+
+    Query parameters: 'limit' (page size), 'cursor' (the 'next_cursor' of the
+    previous page), 'fields' (comma-separated subset of FILE_FIELDS) and
+    'count' (include the user's total number of files). Pages are keyset
+    paginated on (uploaded_at, id), so each one is a short index range scan
+    however deep the client pages.
+    """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("""
-            SELECT id, file_name, file_type, uploaded_at
-            FROM FILES
-            WHERE user_id = %s
-            ORDER BY uploaded_at DESC
-        """, (user['id'],))
-        files = cursor.fetchall()
-        conn.close()
-        return jsonify({"files": files}), 200
+        limit = min(int(request.args.get('limit', config.FILES_PAGE_SIZE)), config.FILES_PAGE_MAX)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        after = file_api.decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({"message": "Invalid pagination parameters.", "error": str(e)}), 400
+
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else file_api.DEFAULT_FILE_FIELDS
+    unknown = [field for field in fields if field not in file_api.FILE_FIELDS]
+    if unknown:
+        return jsonify({"message": f"Unknown fields: {', '.join(unknown)}."}), 400
+    columns = {file_api.FILE_FIELDS[field] for field in fields} | {"id", "uploaded_at"}
+
+    query = f"SELECT {', '.join(sorted(columns))} FROM {file_api.files_source(fields)} WHERE user_id = %s AND deleted_at IS NULL"
+    params = [user['id']]
+    if after:
+        query += " AND (uploaded_at, id) < (%s, %s)"
+        params.extend(after)
+    query += " ORDER BY uploaded_at DESC, id DESC LIMIT %s"
+    params.append(limit + 1)  # one extra row tells us whether another page exists
+
+    try:
+        with db.connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute(query, params)
+            files = cursor.fetchall()
+            total = None
+            if request.args.get('count') in ('1', 'true'):
+                cursor.execute(
+                    "SELECT count(*) AS total FROM FILES WHERE user_id = %s AND deleted_at IS NULL", (user['id'],)
+                )
+                total = cursor.fetchone()['total']
     except psycopg2.Error as db_error:
-        print(f"Database error: {db_error}")  # Log database error
+        instrumentation.log.error("Database error: %s", db_error)
         return jsonify({"message": "Failed to retrieve files.", "error": str(db_error)}), 500
-    except Exception as e:
-        print(f"Unexpected error: {e}")  # Log unexpected errors
-        return jsonify({"message": "Failed to retrieve files.", "error": str(e)}), 500
-@app.route('/delete/<int:file_id>', methods=['DELETE'])
+
+    next_cursor = None
+    if len(files) > limit:
+        files = files[:limit]
+        next_cursor = file_api.encode_cursor(files[-1]['uploaded_at'], files[-1]['id'])
+
+    json = current_app.json  # generate() runs after the app context is gone
+
+    def generate():
+        # Serialize row by row instead of building the whole document in memory
+        yield '{"files": ['
+        for i, file in enumerate(files):
+            yield (',' if i else '') + json.dumps({field: file[field] for field in fields})
+        yield '], "next_cursor": ' + json.dumps(next_cursor)
+        if total is not None:
+            yield ', "total": ' + json.dumps(total)
+        yield '}'
+
+    return Response(generate(), status=200, mimetype='application/json')
+
+
+@bp.route('/files/<int:file_id>', methods=['GET'])
 @token_required
-def delete_file(user, file_id):
-    """Delete a file uploaded by the authenticated user."""
-    try:
-        conn = get_db_connection()
+def download_file(user, file_id):
+    """Stream a file back, honouring Range and If-None-Match."""
+    with db.connection() as conn:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        # Check if the file exists and belongs to the user
         cursor.execute("""
-            SELECT file_name FROM FILES WHERE id = %s AND user_id = %s
+            SELECT f.id, f.file_name, f.file_type, f.file_size, f.chunk_size, f.uploaded_at,
+                   EXISTS (SELECT 1 FROM FILE_CONTENTS c WHERE c.file_id = f.id) AS inline,
+                   f.blob_sha256,
+                   COALESCE(b.storage_path, f.storage_path) AS storage_path,
+                   b.chunk_size AS blob_chunk_size, b.codec,
+                   COALESCE(b.stored_size, b.size) AS stored_size
+            FROM FILES f
+            LEFT JOIN BLOBS b ON b.sha256 = f.blob_sha256
+            WHERE f.id = %s AND f.user_id = %s AND f.deleted_at IS NULL
         """, (file_id, user['id']))
         file = cursor.fetchone()
 
-        if not file:
-            conn.close()
-            return jsonify({"message": "File not found or you do not have permission to delete it."}), 404
-
-        # Delete the file from the database
-        cursor.execute("DELETE FROM FILES WHERE id = %s", (file_id,))
-        conn.commit()
-
-        # Optionally delete the file locally if saved
-        local_file_path = os.path.join('uploads', file['file_name'])  # Adjust the path if needed
-        if os.path.exists(local_file_path):
-            os.remove(local_file_path)
-
-        conn.close()
-        return jsonify({"message": f"File '{file['file_name']}' deleted successfully!"}), 200
-    except Exception as e:
-        if conn:
-            conn.rollback()
-            conn.close()
+    if not file or file['file_size'] is None:
+        return jsonify({"message": "File not found or you do not have permission to access it."}), 404
+
+    # Stored content never changes; blobs are named by their SHA-256 already
+    etag = file['blob_sha256'] or f"{file['id']}-{file['file_size']}-{int(file['uploaded_at'].timestamp())}"
+
+    if file['codec']:
+        return send_compressed(file, etag)
+
+    if file['storage_path']:
+        # send_file handles Range/ETag itself and hands the file to the server's
+        # wsgi.file_wrapper, which uses sendfile() where available.
+        return send_file(
+            storage.local_path(file['storage_path']),
+            mimetype=file['file_type'],
+            as_attachment=True,
+            download_name=file['file_name'],
+            conditional=True,
+            etag=etag,
+            last_modified=file['uploaded_at'],
+        )
+
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes",
+        "Last-Modified": http_date(file['uploaded_at']),
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(file['file_name'])}",
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    size = file['file_size']
+    start, stop, status = 0, size, 200
+    byte_range = request.range
+    if byte_range and (byte_range.units != "bytes" or len(byte_range.ranges) != 1):
+        byte_range = None  # multipart/byteranges is not supported; send the whole file
+    if byte_range and request.if_range.etag not in (None, etag):
+        byte_range = None  # If-Range no longer matches: send the whole file
+    if byte_range:
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    headers["Content-Length"] = str(stop - start)
+
+    if stop == start:
+        body = []
+    elif file['blob_sha256']:
+        body = storage.iter_blob_chunks(file['blob_sha256'], file['blob_chunk_size'], start, stop)
+    elif file['inline']:
+        body = storage.iter_inline(file['id'], start, stop, config.UPLOAD_CHUNK_SIZE)
+    else:
+        body = storage.iter_file_chunks(file['id'], file['chunk_size'], start, stop)
+    return Response(body, status=status, mimetype=file['file_type'], headers=headers, direct_passthrough=True)
+
+
+def send_compressed(file, etag):
+    """Respond with a compressed blob, decompressing it unless the client accepts its encoding.
+
+    Range requests get the whole file: offsets into the content do not map
+    onto the compressed bytes without decompressing everything before them.
+    """
+    passthrough = request.accept_encodings.quality(file['codec']) > 0
+    if passthrough:
+        etag = f"{etag}-{file['codec']}"  # a different representation needs a different tag
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "none",
+        "Vary": "Accept-Encoding",
+        "Last-Modified": http_date(file['uploaded_at']),
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(file['file_name'])}",
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    body = storage.iter_blob(file['blob_sha256'], file['stored_size'], file['blob_chunk_size'], file['storage_path'])
+    if passthrough:
+        headers["Content-Encoding"] = file['codec']
+        headers["Content-Length"] = str(file['stored_size'])
+    else:
+        headers["Content-Length"] = str(file['file_size'])
+        body = compression.decompress(body, file['codec'])
+    return Response(body, status=200, mimetype=file['file_type'], headers=headers, direct_passthrough=True)
+
+
+@bp.route('/delete/<int:file_id>', methods=['DELETE'])
+@token_required
+def delete_file(user, file_id):
+    """Delete a file uploaded by the authenticated user.
+
+    The row is only marked deleted, which hides it from every endpoint at
+    once; reclaimer.reclaim_deleted() removes it and its content later.
+    """
+    try:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(quota.with_release("""
+                UPDATE FILES SET deleted_at = now()
+                WHERE id = %s AND user_id = %s AND deleted_at IS NULL
+                RETURNING file_name, user_id, file_size
+            """), (file_id, user['id']))
+            file = cursor.fetchone()
+            conn.commit()
+    except psycopg2.Error as e:
         return jsonify({"message": "Failed to delete the file.", "error": str(e)}), 500
+
+    if not file:
+        return jsonify({"message": "File not found or you do not have permission to delete it."}), 404
+    return jsonify({"message": f"File '{file[0]}' deleted successfully!"}), 200
+
+
+@bp.route('/delete', methods=['POST'])
+@token_required
+def delete_files(user):
+    """Delete many of the authenticated user's files in one request.
+
+    The JSON body names the files by 'ids' (at most BULK_DELETE_MAX_IDS),
+    by upload date with 'uploaded_before' and/or 'uploaded_after' (ISO
+    8601), or both, in which case a file must match all of them. Like
+    DELETE /delete/<id> this only writes tombstones. The response lists the
+    deleted ids, and with 'ids' also those that were not found.
+    """
+    try:
+        ids, before, after = file_api.parse_bulk_delete(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"message": "Invalid delete request.", "error": str(e)}), 400
+
+    query = "UPDATE FILES SET deleted_at = now() WHERE user_id = %s AND deleted_at IS NULL"
+    params = [user['id']]
+    if ids is not None:
+        query += " AND id = ANY(%s)"
+        params.append(ids)
+    if before is not None:
+        query += " AND uploaded_at < %s"
+        params.append(before)
+    if after is not None:
+        query += " AND uploaded_at >= %s"
+        params.append(after)
+    query += " RETURNING id, user_id, file_size"
+
+    try:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(quota.with_release(query), params)
+            deleted = sorted(row[0] for row in cursor.fetchall())
+            conn.commit()
+    except psycopg2.Error as e:
+        return jsonify({"message": "Failed to delete files.", "error": str(e)}), 500
+
+    result = {"message": f"Deleted {len(deleted)} files.", "deleted": len(deleted), "ids": deleted}
+    if ids is not None:
+        result["not_found"] = sorted(set(ids) - set(deleted))
+    return jsonify(result), 200
+
+
+@bp.route('/usage', methods=['GET'])
+@token_required
+def get_usage(user):
+    """Bytes and files the authenticated user stores, with their quota (null when unlimited)."""
+    with db.connection() as conn:
+        return jsonify(quota.usage(conn.cursor(), user['id'])), 200
+
+
 if __name__ == '__main__':
-    initialize_database()
-    app.run(host="0.0.0.0", port=5002)
+    # Development server; production runs under gunicorn (see entry.sh)
+    import schema
+    schema.migrate()
+    serving.worker_started()
+    create_app().run(host="0.0.0.0", port=int(os.environ.get("UPLOAD_PORT", 5002)))
@@ -0,0 +1,540 @@
+import asyncio
+import itertools
+import json
+import os
+import time
+from functools import wraps
+
+import aiohttp
+import asyncpg
+from aiohttp import web
+from werkzeug.http import http_date
+
+import compression
+import config
+import content
+import db
+import file_api
+import instrumentation
+import quota
+import reclaimer  # only for its serving.on_worker_start hook, which runs the blob reclaimer
+import revocation
+import serving
+import storage
+import token_cache
+
+# asyncio implementation of the upload service's /upload, /files,
+# /delete/<id>, /delete and /usage, with the same request and response formats as
+# auth_upload.py. Each request is a coroutine rather than a thread, so
+# thousands of slow uploads can be in flight at once; body bytes are only
+# read off the socket as fast as they are written to the spool file, which
+# gives backpressure.
+# Downloads (GET /files/<id>) and POST /upload/batch are not implemented here;
+# they are forwarded to the Flask service at UPLOAD_FALLBACK_URL, which
+# entry.sh runs next to this one.
+# Run it with "python auth_upload_async.py" or under gunicorn with
+# "--worker-class aiohttp.GunicornWebWorker 'auth_upload_async:create_app()'".
+
+SECRET_KEY = 'test'
+POOL = web.AppKey("pool", asyncpg.Pool)
+CLIENT = web.AppKey("client", aiohttp.ClientSession)
+# Leave room for multipart framing; each file is capped at UPLOAD_MAX_SIZE while streaming
+MULTIPART_OVERHEAD = 64 * 1024
+# Headers that describe one connection, so they are not passed on when forwarding
+HOP_BY_HOP = {
+    "connection", "host", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade",
+}
+
+instrumentation.register_gauges("db_pool", db.pool_metrics)
+instrumentation.register_gauges("token_cache", token_cache.cache.stats)
+instrumentation.register_gauges("compression", compression.stats.stats)
+
+
+def json_response(data, status=200, headers=None):
+    return web.json_response(data, status=status, headers=headers, dumps=dumps)
+
+
+def dumps(obj):
+    # Matches Flask's JSON provider, which renders datetimes as HTTP dates
+    return json.dumps(obj, default=lambda o: http_date(o) if hasattr(o, "timetuple") else str(o))
+
+
+def acquire(request):
+    """Borrow a pooled connection, waiting at most DB_POOL_TIMEOUT seconds."""
+    return request.app[POOL].acquire(timeout=config.DB_POOL_TIMEOUT)
+
+
+@web.middleware
+async def observe(request, handler):
+    """Record each request in the same http_request_duration_seconds histogram as the Flask services."""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        endpoint = resource.canonical if resource else "<unmatched>"
+        instrumentation.request_duration.observe(
+            time.perf_counter() - started, "upload", endpoint, request.method, str(status)
+        )
+
+
+@web.middleware
+async def pool_timeout(request, handler):
+    try:
+        return await handler(request)
+    except asyncio.TimeoutError:
+        return json_response({"message": "Service is busy, please retry."}, 503, {"Retry-After": "1"})
+
+
+# asyncpg versions of revocation.LOOKUPS
+LOOKUPS = {
+    revocation.USER_LOOKUP: """
+        SELECT *, EXISTS (SELECT 1 FROM REVOKED_TOKENS WHERE jti = $1) AS revoked
+        FROM "USER" WHERE id = $2
+    """,
+    revocation.REVOKED_LOOKUP: "SELECT 1 FROM REVOKED_TOKENS WHERE jti = $1",
+}
+
+
+async def verify_token(request, token):
+    """asyncpg driver for revocation.verification(); same result as revocation.verify_token()."""
+    steps = revocation.verification(token, SECRET_KEY)
+    try:
+        lookup, params = next(steps)
+        while True:
+            async with acquire(request) as conn:
+                row = await conn.fetchrow(LOOKUPS[lookup], *params)
+            lookup, params = steps.send(None if row is None else dict(row))
+    except StopIteration as done:
+        return done.value, None
+    except revocation.InvalidToken as e:
+        return None, e.response
+
+
+def token_required(f):
+    @wraps(f)
+    async def decorated(request):
+        token = request.query.get("token")
+        if not token:
+            return json_response({"message": "Token is missing!"}, 401)
+
+        user, error = await verify_token(request, token)
+        if error:
+            return json_response(error, 401)
+
+        return await f(request, user)
+    return decorated
+
+
+async def spool_stream(read, max_size):
+    """Stage a body in a temporary file, awaiting ``read()`` for each piece until it returns b''.
+
+    The file is written from a thread, so a slow disk never stalls the event loop.
+    """
+    spooler = await asyncio.to_thread(storage.Spooler, max_size)
+    try:
+        while True:
+            chunk = await read()
+            if not chunk:
+                return await asyncio.to_thread(spooler.finish)
+            await asyncio.to_thread(spooler.write, chunk)
+    except BaseException:
+        spooler.abort()
+        raise
+
+
+async def store_blob(conn, spooled, chunk_size):
+    """asyncpg version of storage.store_blob(); must run inside a transaction."""
+    storage_path = storage.blob_path(spooled.sha256, spooled.codec) if config.STORAGE_BACKEND == "disk" else None
+    inserted = await conn.fetchval("""
+        INSERT INTO BLOBS (sha256, size, chunk_size, storage_path, refcount, codec, stored_size)
+        VALUES ($1, $2, $3, $4, 1, $5, $6)
+        ON CONFLICT (sha256) DO UPDATE SET refcount = BLOBS.refcount + 1
+        RETURNING (xmax = 0) AS inserted
+    """, spooled.sha256, spooled.size, chunk_size, storage_path, spooled.codec, spooled.stored_size)
+    if not inserted:
+        return None  # identical content is already stored
+
+    # File access runs in threads, off the event loop
+    if storage_path:
+        return await asyncio.to_thread(storage.move_blob, spooled, storage_path)
+
+    with await asyncio.to_thread(spooled.open) as source:
+        chunks = storage.read_chunks(source, chunk_size)
+        for seq in itertools.count():
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            await conn.execute(
+                "INSERT INTO BLOB_CHUNKS (sha256, seq, data) VALUES ($1, $2, $3)",
+                spooled.sha256, seq, chunk
+            )
+    return None
+
+
+async def quota_left(request, user):
+    """asyncpg version of auth_upload.quota_left()."""
+    if not quota.enabled():
+        return None, None
+    async with acquire(request) as conn:
+        row = await conn.fetchrow("SELECT bytes, files FROM USER_USAGE WHERE user_id = $1", user['id'])
+    return quota.remaining(*(row or (0, 0)))
+
+
+async def charge_quota(conn, user_id, size):
+    """asyncpg version of quota.charge() for one file."""
+    row = await conn.fetchrow("""
+        INSERT INTO USER_USAGE (user_id, bytes, files) VALUES ($1, $2, 1)
+        ON CONFLICT (user_id) DO UPDATE
+        SET bytes = USER_USAGE.bytes + EXCLUDED.bytes, files = USER_USAGE.files + EXCLUDED.files
+        RETURNING bytes, files
+    """, user_id, size)
+    if quota.exceeds(*row):
+        raise quota.QuotaExceeded()
+
+
+@token_required
+async def upload_file(request, user):
+    """Same contract as auth_upload.upload_file(): multipart 'file' or a raw body."""
+    if request.content_length is not None and request.content_length > config.UPLOAD_MAX_SIZE + MULTIPART_OVERHEAD:
+        return json_response({"message": "File is too large!"}, 413)
+
+    bytes_left, files_left = await quota_left(request, user)
+    if files_left == 0 or (bytes_left is not None and request.content_length is not None
+                           and request.content_length > bytes_left + MULTIPART_OVERHEAD):
+        return json_response({"message": "Storage quota exceeded!"}, 413)
+    max_size = config.UPLOAD_MAX_SIZE if bytes_left is None else min(config.UPLOAD_MAX_SIZE, bytes_left)
+
+    try:
+        if request.content_type == 'multipart/form-data':
+            reader = await request.multipart()
+            while True:
+                part = await reader.next()
+                if part is None:
+                    return json_response({"message": "No file provided!"}, 400)
+                if part.name == 'file':
+                    break
+                await part.release()
+            file_name = part.filename
+            file_type = part.headers.get('Content-Type', 'application/octet-stream').split(';')[0].strip()
+            read = lambda: part.read_chunk(config.UPLOAD_CHUNK_SIZE)
+        else:
+            file_name = request.query.get('name') or request.headers.get('X-File-Name')
+            file_type = request.content_type
+            read = lambda: request.content.read(config.UPLOAD_CHUNK_SIZE)
+            if not file_name:
+                return json_response({"message": "No file provided!"}, 400)
+
+        # Read the body before borrowing a connection so slow clients don't hold one
+        with await spool_stream(read, max_size) as spooled:
+            file_type = content.sniff_type(spooled.head, file_name, file_type)
+            if file_type not in file_api.ALLOWED_TYPES:
+                return json_response({"message": f"Invalid file type! Only .pdf, .txt, and .csv are allowed."}, 400)
+            codec = compression.codec_for(file_type)
+            if codec:
+                await asyncio.to_thread(spooled.compress, codec, config.COMPRESSION_LEVEL)
+
+            async with acquire(request) as conn:
+                transaction = conn.transaction()
+                await transaction.start()
+                written = None
+                try:
+                    written = await store_blob(conn, spooled, config.UPLOAD_CHUNK_SIZE)
+                    file_id = await conn.fetchval("""
+                        INSERT INTO FILES (user_id, file_name, file_type, file_size, blob_sha256)
+                        VALUES ($1, $2, $3, $4, $5)
+                        RETURNING id
+                    """, user['id'], file_name, file_type, spooled.size, spooled.sha256)
+                    if file_type == 'text/csv':
+                        await conn.execute(
+                            "INSERT INTO BLOB_INDEX (sha256) VALUES ($1) ON CONFLICT (sha256) DO NOTHING",
+                            spooled.sha256
+                        )
+                    # Last, so the usage row is only locked for the commit
+                    await charge_quota(conn, user['id'], spooled.size)
+                    await transaction.commit()
+                except BaseException:
+                    # Still holding the BLOBS row lock, so no other upload can be using this copy
+                    if written:
+                        storage.remove_file(written)
+                    if not transaction.is_completed():
+                        await transaction.rollback()
+                    raise
+        return json_response({
+            "message": f"File '{file_name}' uploaded successfully!",
+            "id": file_id,
+            "file_type": file_type,
+            "size": spooled.size,
+            "sha256": spooled.sha256,
+        }, 201)
+    except storage.FileTooLarge:
+        if max_size < config.UPLOAD_MAX_SIZE:
+            return json_response({"message": "Storage quota exceeded!"}, 413)
+        return json_response({"message": "File is too large!"}, 413)
+    except quota.QuotaExceeded:
+        return json_response({"message": "Storage quota exceeded!"}, 413)
+    except asyncpg.PostgresError as e:
+        return json_response({"message": "Failed to upload file.", "error": str(e)}, 500)
+
+
+@token_required
+async def list_files(request, user):
+    """Same contract as auth_upload.list_files(), streamed row by row."""
+    try:
+        limit = min(int(request.query.get('limit', config.FILES_PAGE_SIZE)), config.FILES_PAGE_MAX)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        after = file_api.decode_cursor(request.query['cursor']) if request.query.get('cursor') else None
+    except ValueError as e:
+        return json_response({"message": "Invalid pagination parameters.", "error": str(e)}, 400)
+
+    fields = request.query.get('fields')
+    fields = fields.split(',') if fields else file_api.DEFAULT_FILE_FIELDS
+    unknown = [field for field in fields if field not in file_api.FILE_FIELDS]
+    if unknown:
+        return json_response({"message": f"Unknown fields: {', '.join(unknown)}."}, 400)
+    columns = {file_api.FILE_FIELDS[field] for field in fields} | {"id", "uploaded_at"}
+
+    query = f"SELECT {', '.join(sorted(columns))} FROM {file_api.files_source(fields)} WHERE user_id = $1 AND deleted_at IS NULL"
+    params = [user['id']]
+    if after:
+        query += " AND (uploaded_at, id) < ($2, $3)"
+        params.extend(after)
+    query += f" ORDER BY uploaded_at DESC, id DESC LIMIT ${len(params) + 1}"
+    params.append(limit + 1)  # one extra row tells us whether another page exists
+
+    try:
+        async with acquire(request) as conn:
+            files = await conn.fetch(query, *params)
+            total = None
+            if request.query.get('count') in ('1', 'true'):
+                total = await conn.fetchval(
+                    "SELECT count(*) FROM FILES WHERE user_id = $1 AND deleted_at IS NULL", user['id']
+                )
+    except asyncpg.PostgresError as db_error:
+        return json_response({"message": "Failed to retrieve files.", "error": str(db_error)}, 500)
+
+    next_cursor = None
+    if len(files) > limit:
+        files = files[:limit]
+        next_cursor = file_api.encode_cursor(files[-1]['uploaded_at'], files[-1]['id'])
+
+    response = web.StreamResponse(status=200, headers={"Content-Type": "application/json"})
+    await response.prepare(request)
+    await response.write(b'{"files": [')
+    for i, file in enumerate(files):
+        # Each write waits for the transport to drain, so slow readers don't buffer the page
+        await response.write(((',' if i else '') + dumps({field: file[field] for field in fields})).encode('utf-8'))
+    tail = '], "next_cursor": ' + dumps(next_cursor)
+    if total is not None:
+        tail += ', "total": ' + dumps(total)
+    await response.write((tail + '}').encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+@token_required
+async def get_usage(request, user):
+    """Same contract as auth_upload.get_usage()."""
+    async with acquire(request) as conn:
+        row = await conn.fetchrow("SELECT bytes, files FROM USER_USAGE WHERE user_id = $1", user['id'])
+    return json_response(quota.describe(*(row or (0, 0))), 200)
+
+
+@token_required
+async def delete_file(request, user):
+    """Same contract as auth_upload.delete_file(): the row becomes a tombstone."""
+    file_id = int(request.match_info['file_id'])
+    try:
+        async with acquire(request) as conn:
+            file_name = await conn.fetchval(quota.with_release("""
+                UPDATE FILES SET deleted_at = now()
+                WHERE id = $1 AND user_id = $2 AND deleted_at IS NULL
+                RETURNING file_name, user_id, file_size
+            """), file_id, user['id'])
+    except asyncpg.PostgresError as e:
+        return json_response({"message": "Failed to delete the file.", "error": str(e)}, 500)
+
+    if file_name is None:
+        return json_response({"message": "File not found or you do not have permission to delete it."}, 404)
+    return json_response({"message": f"File '{file_name}' deleted successfully!"}, 200)
+
+
+@token_required
+async def delete_files(request, user):
+    """Same contract as auth_upload.delete_files()."""
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    try:
+        ids, before, after = file_api.parse_bulk_delete(body)
+    except ValueError as e:
+        return json_response({"message": "Invalid delete request.", "error": str(e)}, 400)
+
+    query = "UPDATE FILES SET deleted_at = now() WHERE user_id = $1 AND deleted_at IS NULL"
+    params = [user['id']]
+    if ids is not None:
+        params.append(ids)
+        query += f" AND id = ANY(${len(params)})"
+    if before is not None:
+        params.append(before)
+        query += f" AND uploaded_at < ${len(params)}::timestamptz"
+    if after is not None:
+        params.append(after)
+        query += f" AND uploaded_at >= ${len(params)}::timestamptz"
+    query += " RETURNING id, user_id, file_size"
+
+    try:
+        async with acquire(request) as conn:
+            deleted = sorted(row['id'] for row in await conn.fetch(quota.with_release(query), *params))
+    except asyncpg.PostgresError as e:
+        return json_response({"message": "Failed to delete files.", "error": str(e)}, 500)
+
+    result = {"message": f"Deleted {len(deleted)} files.", "deleted": len(deleted), "ids": deleted}
+    if ids is not None:
+        result["not_found"] = sorted(set(ids) - set(deleted))
+    return json_response(result, 200)
+
+
+async def forward(request):
+    """Hand a request this service does not implement to the Flask upload service.
+
+    Both bodies are streamed through, so a download or a batch upload is
+    never held in memory here.
+    """
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP}
+    response = None
+    try:
+        async with request.app[CLIENT].request(
+            request.method,
+            config.UPLOAD_FALLBACK_URL + str(request.rel_url),
+            headers=headers,
+            data=request.content if request.body_exists else None,
+        ) as upstream:
+            response = web.StreamResponse(status=upstream.status, headers={
+                name: value for name, value in upstream.headers.items() if name.lower() not in HOP_BY_HOP
+            })
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_chunked(config.UPLOAD_CHUNK_SIZE):
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        if response is not None:
+            # Part of the response is already out; drop the connection so the client sees it was cut short
+            raise ConnectionResetError(f"Forwarding to {config.UPLOAD_FALLBACK_URL} failed: {e}") from e
+        return json_response({"message": "Upload service unavailable.", "error": str(e)}, 502)
+
+
+async def metrics(request):
+    return web.Response(
+        body=instrumentation.render_metrics().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4"},
+    )
+
+
+def pool_sizes():
+    """Split this worker's DB_POOL_MAX connections into (asyncpg, db.py) pool sizes."""
+    background = max(min(config.DB_BACKGROUND_POOL_MAX, config.DB_POOL_MAX - 1), 1)
+    return max(config.DB_POOL_MAX - background, 1), background
+
+
+def asyncpg_pool_metrics(app):
+    pool = app.get(POOL)
+    if pool is None:
+        return {}
+    return {
+        "size": pool.get_size(),
+        "idle": pool.get_idle_size(),
+        "in_use": pool.get_size() - pool.get_idle_size(),
+        "min_size": pool.get_min_size(),
+        "max_size": pool.get_max_size(),
+    }
+
+
+async def healthz(request):
+    return json_response({"status": "ok"}, 200)
+
+
+async def readyz(request):
+    try:
+        async with request.app[POOL].acquire(timeout=config.READY_TIMEOUT) as conn:
+            await conn.fetchval("SELECT 1")
+    except Exception as e:
+        return json_response({"status": "unavailable", "error": str(e)}, 503)
+    return json_response({"status": "ok"}, 200)
+
+
+async def start_background_workers(app):
+    # Under gunicorn post_worker_init has already done this and the call is a
+    # no-op; it matters for "python auth_upload_async.py". The background
+    # threads use the psycopg2 pool from db.py, so run it off the event loop.
+    await asyncio.to_thread(serving.worker_started)
+
+
+async def init_connection(conn):
+    # BLOB_INDEX metadata comes back as Python lists, as it does from psycopg2
+    await conn.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+async def open_pool(app):
+    max_size = pool_sizes()[0]
+    app[POOL] = await asyncpg.create_pool(
+        min_size=min(config.DB_POOL_MIN, max_size),
+        max_size=max_size,
+        database=config.DATABASE_CONFIG["dbname"],
+        user=config.DATABASE_CONFIG["user"],
+        password=config.DATABASE_CONFIG["password"],
+        host=config.DATABASE_CONFIG["host"],
+        port=config.DATABASE_CONFIG["port"],
+        init=init_connection,
+    )
+    yield
+    await app[POOL].close()
+
+
+async def open_client(app):
+    app[CLIENT] = aiohttp.ClientSession(
+        # Compressed downloads are passed on as they are, Content-Encoding and all
+        auto_decompress=False,
+        timeout=aiohttp.ClientTimeout(total=None, sock_read=config.UPLOAD_FALLBACK_TIMEOUT),
+    )
+    yield
+    await app[CLIENT].close()
+
+
+def create_app():
+    # Requests use asyncpg; db.py's pool only serves the background threads
+    db.limit_pool(pool_sizes()[1])
+    app = web.Application(
+        middlewares=[observe, pool_timeout], client_max_size=config.UPLOAD_MAX_SIZE + MULTIPART_OVERHEAD
+    )
+    app.cleanup_ctx.append(open_pool)
+    app.cleanup_ctx.append(open_client)
+    instrumentation.register_gauges("asyncpg_pool", lambda: asyncpg_pool_metrics(app))
+    app.on_startup.append(start_background_workers)
+    app.router.add_post('/upload', upload_file)
+    app.router.add_get('/files', list_files)
+    app.router.add_delete(r'/delete/{file_id:\d+}', delete_file)
+    app.router.add_post('/delete', delete_files)
+    app.router.add_get('/usage', get_usage)
+    app.router.add_get('/healthz', healthz)
+    app.router.add_get('/readyz', readyz)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get(r'/files/{file_id:\d+}', forward)
+    app.router.add_post('/upload/batch', forward)
+    return app
+
+
+if __name__ == '__main__':
+    import schema
+    schema.migrate()
+    web.run_app(create_app(), host="0.0.0.0", port=int(os.environ.get("UPLOAD_PORT", 5002)))
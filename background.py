@@ -0,0 +1,23 @@
+import threading
+
+import instrumentation
+
+
+class PeriodicWorker(threading.Thread):
+    """Daemon thread that calls ``func`` every ``interval`` seconds until stopped."""
+
+    def __init__(self, name, interval, func):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.func = func
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.func()
+            except Exception:
+                instrumentation.log.exception("Background task %s failed", self.name)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,311 @@
+"""Load generator for the auth (5001) and upload (5002) services.
+
+Runs a weighted mix of register/login/protected/upload/list/download/delete
+requests from ``--concurrency`` threads for ``--duration`` seconds and
+reports throughput and p50/p95/p99 latency per endpoint. Results are written
+to JSON so runs on different commits can be compared with ``--compare``.
+
+With ``--start`` the services are launched from this checkout (against the
+Postgres named in db.json, or DB_CONFIG) and stopped afterwards; otherwise
+they must already be running at ``--auth-url`` and ``--upload-url``.
+
+    python bench.py --start --duration 30 --concurrency 16 --output base.json
+    python bench.py --start --mix protected=1 --compare base.json
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from auth_client import percentile
+
+OPERATIONS = ["register", "login", "protected", "upload", "list", "download", "delete"]
+DEFAULT_MIX = "register=1,login=2,protected=20,upload=5,list=10,download=5,delete=2"
+SERVICES = [("auth.py", "auth_url"), ("auth_upload.py", "upload_url")]
+# Status each endpoint answers with on success; anything else counts as an error
+EXPECTED_STATUS = {
+    "register": 201, "login": 200, "protected": 200, "upload": 201,
+    "list": 200, "download": 200, "delete": 200,
+}
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class Worker:
+    """One benchmark thread with its own user, token and uploaded files."""
+
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.random = random.Random(bench.args.seed + index)
+        self.username = f"bench-{bench.run_id}-{index}"
+        self.password = "bench-password"
+        self.token = None
+        self.file_ids = []
+
+    def request(self, endpoint, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.bench.session.request(method, url, timeout=self.bench.args.timeout, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, None
+        self.bench.record(endpoint, time.perf_counter() - started, status)
+        return response
+
+    def register(self, username=None):
+        return self.request("register", "POST", f"{self.bench.args.auth_url}/register", json={
+            "email": f"{username or self.username}@bench.invalid",
+            "username": username or self.username,
+            "password": self.password,
+        })
+
+    def login(self):
+        response = self.request("login", "POST", f"{self.bench.args.auth_url}/login", json={
+            "username": self.username,
+            "password": self.password,
+        })
+        if response is not None and response.status_code == 200:
+            self.token = response.json()["token"]
+
+    def protected(self):
+        self.request("protected", "GET", f"{self.bench.args.auth_url}/protected",
+                     headers={"Authorization": self.token})
+
+    def upload(self):
+        response = self.request("upload", "POST", f"{self.bench.args.upload_url}/upload",
+                                params={"token": self.token, "name": f"bench-{uuid.uuid4().hex}.csv"},
+                                data=self.bench.payload(self.random),
+                                headers={"Content-Type": "text/csv"})
+        if response is not None and response.status_code == 201:
+            self.file_ids.append(response.json()["id"])
+
+    def list(self):
+        self.request("list", "GET", f"{self.bench.args.upload_url}/files", params={"token": self.token})
+
+    def download(self):
+        if not self.file_ids:
+            return self.upload()
+        self.request("download", "GET", f"{self.bench.args.upload_url}/files/{self.random.choice(self.file_ids)}",
+                     params={"token": self.token})
+
+    def delete(self):
+        if not self.file_ids:
+            return self.upload()
+        file_id = self.file_ids.pop(self.random.randrange(len(self.file_ids)))
+        self.request("delete", "DELETE", f"{self.bench.args.upload_url}/delete/{file_id}",
+                     params={"token": self.token})
+
+    def setup(self):
+        self.register()
+        self.login()
+        if not self.token:
+            raise RuntimeError(f"Could not log in as {self.username}; is the database reachable?")
+
+    def run(self, names, weights, deadline):
+        while time.monotonic() < deadline:
+            name = self.random.choices(names, weights)[0]
+            if name == "register":
+                self.register(f"{self.username}-{uuid.uuid4().hex[:12]}")
+            else:
+                getattr(self, name)()
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.run_id = uuid.uuid4().hex[:8]
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=args.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.recording = False
+        self._lock = threading.Lock()
+        self._samples = {}  # endpoint -> list of (latency, status)
+        self._rows = None
+
+    def payload(self, rng):
+        """``file_size`` bytes of CSV; the service rejects binary content.
+
+        Rows of random printable fields are generated once and each upload
+        gets a unique first row, so content is never deduplicated.
+        """
+        if self._rows is None:
+            alphabet = string.ascii_letters + string.digits
+            rows = ["id,name,value\n"]
+            size = len(rows[0])
+            while size < self.args.file_size:
+                row = f"{len(rows)},{''.join(rng.choices(alphabet, k=12))},{rng.random():.6f}\n"
+                rows.append(row)
+                size += len(row)
+            self._rows = "".join(rows).encode("ascii")
+        unique = f"{uuid.UUID(int=rng.getrandbits(128)).hex},0,0\n".encode("ascii")
+        return (unique + self._rows)[:max(self.args.file_size, len(unique))]
+
+    def record(self, endpoint, latency, status):
+        if not self.recording:
+            return
+        with self._lock:
+            self._samples.setdefault(endpoint, []).append((latency, status))
+
+    def run(self):
+        weights = parse_mix(self.args.mix)
+        workers = [Worker(self, i) for i in range(self.args.concurrency)]
+        for worker in workers:
+            worker.setup()
+
+        self.recording = True
+        started = time.monotonic()
+        deadline = started + self.args.duration
+        threads = [
+            threading.Thread(target=worker.run, args=(list(weights), list(weights.values()), deadline))
+            for worker in workers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        self.recording = False
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint, samples in sorted(self._samples.items()):
+            latencies = sorted(latency for latency, _ in samples)
+            errors = sum(1 for _, status in samples if status != EXPECTED_STATUS[endpoint])
+            endpoints[endpoint] = {
+                "requests": len(samples),
+                "errors": errors,
+                "throughput": len(samples) / elapsed,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "max_ms": latencies[-1] * 1000,
+            }
+        total = sum(result["requests"] for result in endpoints.values())
+        return {
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "settings": {
+                "mix": self.args.mix,
+                "concurrency": self.args.concurrency,
+                "duration": self.args.duration,
+                "file_size": self.args.file_size,
+                "seed": self.args.seed,
+            },
+            "elapsed": elapsed,
+            "requests": total,
+            "throughput": total / elapsed,
+            "endpoints": endpoints,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_services(args):
+    """Launch auth.py and auth_upload.py and wait until both answer."""
+    processes = []
+    for script, url_arg in SERVICES:
+        log = open(f"bench-{os.path.splitext(script)[0]}.log", "w")
+        processes.append(subprocess.Popen([sys.executable, script], stdout=log, stderr=subprocess.STDOUT))
+        url = getattr(args, url_arg)
+        deadline = time.monotonic() + args.startup_timeout
+        while True:
+            try:
+                requests.get(url, timeout=1)
+                break
+            except requests.ConnectionError:
+                if processes[-1].poll() is not None or time.monotonic() > deadline:
+                    stop_services(processes)
+                    raise RuntimeError(f"{script} did not start; see {log.name}")
+                time.sleep(0.2)
+    return processes
+
+
+def stop_services(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def print_report(result, baseline=None):
+    print(f"{result['requests']} requests in {result['elapsed']:.1f}s "
+          f"({result['throughput']:.1f} req/s) at commit {result['commit']}")
+    print(f"{'endpoint':<10} {'req/s':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, stats in result["endpoints"].items():
+        line = (f"{endpoint:<10} {stats['throughput']:>9.1f} {stats['errors']:>7} "
+                f"{stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}")
+        before = (baseline or {}).get("endpoints", {}).get(endpoint)
+        if before:
+            line += "   " + "  ".join(
+                f"{key.split('_')[0]} {(stats[key] - before[key]) / before[key] * 100:+.0f}%"
+                for key in ("throughput", "p50_ms", "p99_ms") if before[key]
+            )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the auth and upload services.")
+    parser.add_argument("--auth-url", default="http://127.0.0.1:5001")
+    parser.add_argument("--upload-url", default="http://127.0.0.1:5002")
+    parser.add_argument("--start", action="store_true", help="launch the services from this checkout")
+    parser.add_argument("--startup-timeout", type=float, default=30)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="comma-separated operation=weight pairs")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10, help="seconds to measure for")
+    parser.add_argument("--file-size", type=int, default=4096, help="bytes per uploaded file")
+    parser.add_argument("--timeout", type=float, default=30, help="per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="show changes against a previous JSON result")
+    args = parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    processes = start_services(args) if args.start else []
+    try:
+        result = Benchmark(args).run()
+    finally:
+        stop_services(processes)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import threading
+import time
+import zlib
+
+import config
+
+CODECS = ("gzip", "zstd")
+# PDFs are compressed internally already; recompressing them costs CPU for nothing
+COMPRESSIBLE_TYPES = {"text/plain", "text/csv"}
+
+
+class CompressionStats:
+    """Process-wide byte and CPU counters, exported as compression_* gauges."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.decompress_seconds = 0.0
+
+    def compressed(self, bytes_in, bytes_out, seconds):
+        with self._lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.compress_seconds += seconds
+
+    def decompressed(self, seconds):
+        with self._lock:
+            self.decompress_seconds += seconds
+
+    def stats(self):
+        return {
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": self.bytes_in / self.bytes_out if self.bytes_out else 0,
+            "compress_cpu_seconds": self.compress_seconds,
+            "decompress_cpu_seconds": self.decompress_seconds,
+        }
+
+
+stats = CompressionStats()
+
+
+def codec_for(file_type):
+    """Codec new content of ``file_type`` is stored with, or None to store it raw."""
+    if config.STORAGE_COMPRESSION == "none" or file_type not in COMPRESSIBLE_TYPES:
+        return None
+    return config.STORAGE_COMPRESSION
+
+
+def _compressor(codec, level):
+    if codec == "gzip":
+        # wbits=31 writes a gzip container, which can be served as Content-Encoding: gzip
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    import zstandard  # optional; only needed with STORAGE_COMPRESSION=zstd
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def _decompressor(codec):
+    if codec == "gzip":
+        return zlib.decompressobj(31)
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def compress(chunks, codec, level):
+    """Yield ``chunks`` compressed with ``codec``, counting bytes and CPU time in ``stats``."""
+    compressor = _compressor(codec, level)
+    for chunk in chunks:
+        started = time.thread_time()
+        data = compressor.compress(chunk)
+        stats.compressed(len(chunk), len(data), time.thread_time() - started)
+        if data:
+            yield data
+    started = time.thread_time()
+    data = compressor.flush()
+    stats.compressed(0, len(data), time.thread_time() - started)
+    yield data
+
+
+def decompress(chunks, codec):
+    """Yield the original content of ``codec``-compressed ``chunks``."""
+    decompressor = _decompressor(codec)
+    for chunk in chunks:
+        started = time.thread_time()
+        data = decompressor.decompress(chunk)
+        stats.decompressed(time.thread_time() - started)
+        if data:
+            yield data
+    if codec == "gzip":
+        data = decompressor.flush()
+        if data:
+            yield data
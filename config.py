@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+
+
+class ConfigError(ValueError):
+    """Raised for a missing or invalid setting."""
+
+
+# Database connection settings come from db.json next to this file, or the file
+# named by DB_CONFIG. They are read on first use of DATABASE_CONFIG, not at
+# import, so tools and services that never open a connection don't need them.
+DB_CONFIG_PATH = os.environ.get("DB_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "db.json"))
+DATABASE_KEYS = ("dbname", "user", "password", "host", "port")
+
+_database_config = None
+_database_config_lock = threading.Lock()
+
+
+def load_database_config(path=None):
+    path = path or DB_CONFIG_PATH
+    try:
+        with open(path, "r") as file:
+            settings = json.load(file)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ConfigError(f"Cannot read database config {path}: {e}")
+    missing = [key for key in DATABASE_KEYS if key not in settings]
+    if missing:
+        raise ConfigError(f"Database config {path} is missing {', '.join(missing)}")
+    return settings
+
+
+def __getattr__(name):
+    global _database_config
+    if name == "DATABASE_CONFIG":
+        if _database_config is None:
+            with _database_config_lock:
+                if _database_config is None:
+                    _database_config = load_database_config()
+        return _database_config
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Connection pool shared by auth.py and auth_upload.py. Under gunicorn each
+# worker has its own; gunicorn.conf.py sets DB_POOL_MAX from
+# DB_CONNECTION_BUDGET unless it is given explicitly.
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+# Connections out of each async upload worker's DB_POOL_MAX kept for its
+# background threads, which use db.py's pool; asyncpg gets the rest
+DB_BACKGROUND_POOL_MAX = int(os.environ.get("DB_BACKGROUND_POOL_MAX", 2))
+# Seconds a request waits for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+# Idle connections older than this many seconds are pinged before reuse
+DB_POOL_CHECK_IDLE = float(os.environ.get("DB_POOL_CHECK_IDLE", 30))
+
+# Cache of verified tokens used by token_required in both services
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+# Entries never outlive the JWT exp; this caps how stale a cached user row may get
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", 60))
+
+# "database" looks the user up on every uncached request; "stateless" trusts the
+# signed claims and only checks a Bloom filter of revoked token IDs, refreshed
+# from REVOKED_TOKENS every REVOCATION_REFRESH_INTERVAL seconds
+TOKEN_VERIFICATION = os.environ.get("TOKEN_VERIFICATION", "database")
+REVOCATION_REFRESH_INTERVAL = float(os.environ.get("REVOCATION_REFRESH_INTERVAL", 5))
+REVOCATION_CAPACITY = int(os.environ.get("REVOCATION_CAPACITY", 100000))
+REVOCATION_ERROR_RATE = float(os.environ.get("REVOCATION_ERROR_RATE", 0.001))
+
+# Password hashing (see hashing.py)
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+# "thread" relies on bcrypt releasing the GIL; "process" isolates hashing in worker processes
+HASH_EXECUTOR = os.environ.get("HASH_EXECUTOR", "thread")
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", os.cpu_count() or 1))
+# Hash jobs allowed to wait for a worker before requests are rejected with 429
+HASH_QUEUE_SIZE = int(os.environ.get("HASH_QUEUE_SIZE", HASH_WORKERS * 4))
+HASH_RETRY_AFTER = int(os.environ.get("HASH_RETRY_AFTER", 1))
+
+# Uploads are streamed into FILE_CHUNKS rows of this many bytes
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 256 * 1024))
+# Largest accepted upload, enforced while the body is being read
+UPLOAD_MAX_SIZE = int(os.environ.get("UPLOAD_MAX_SIZE", 100 * 1024 * 1024))
+# With UPLOAD_SERVER=async (see entry.sh) the aiohttp service answers on the
+# upload port and forwards what it does not implement, downloads and batch
+# uploads, to the Flask upload service at this URL
+UPLOAD_FALLBACK_URL = os.environ.get("UPLOAD_FALLBACK_URL", "http://127.0.0.1:5003")
+# Seconds the async service waits for the Flask one to send more of a response
+UPLOAD_FALLBACK_TIMEOUT = float(os.environ.get("UPLOAD_FALLBACK_TIMEOUT", 120))
+# Limits for POST /upload/batch: total request size and number of files
+UPLOAD_BATCH_MAX_SIZE = int(os.environ.get("UPLOAD_BATCH_MAX_SIZE", 500 * 1024 * 1024))
+UPLOAD_BATCH_MAX_FILES = int(os.environ.get("UPLOAD_BATCH_MAX_FILES", 10000))
+
+# Leading bytes of each upload used to detect its real type
+SNIFF_BYTES = int(os.environ.get("SNIFF_BYTES", 8192))
+# CSV uploads are indexed (row count, columns, preview) by a background worker
+# that claims up to INDEX_BATCH queued blobs every INDEX_INTERVAL seconds
+INDEX_INTERVAL = float(os.environ.get("INDEX_INTERVAL", 2))
+INDEX_BATCH = int(os.environ.get("INDEX_BATCH", 10))
+# Claims older than this many seconds are assumed lost with their worker and retried
+INDEX_CLAIM_TIMEOUT = int(os.environ.get("INDEX_CLAIM_TIMEOUT", 600))
+CSV_PREVIEW_ROWS = int(os.environ.get("CSV_PREVIEW_ROWS", 5))
+
+# Where new upload content is kept: "database" (FILE_CHUNKS) or "disk" (STORAGE_DIR)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "database")
+STORAGE_DIR = os.environ.get("STORAGE_DIR", "storage")
+# Text uploads are compressed at ingest with this codec: "none", "gzip" or "zstd"
+# (zstd needs the zstandard package); COMPRESSION_LEVEL defaults to the codec's own
+STORAGE_COMPRESSION = os.environ.get("STORAGE_COMPRESSION", "none")
+COMPRESSION_LEVEL = int(os.environ.get("COMPRESSION_LEVEL", 3 if STORAGE_COMPRESSION == "zstd" else 6))
+# Chunks fetched per query when streaming a download out of the database
+DOWNLOAD_BATCH_CHUNKS = int(os.environ.get("DOWNLOAD_BATCH_CHUNKS", 4))
+
+# Per-user storage limits, counted in uploaded bytes and live files (0 means unlimited)
+QUOTA_BYTES = int(os.environ.get("QUOTA_BYTES", 0))
+QUOTA_FILES = int(os.environ.get("QUOTA_FILES", 0))
+
+# Tombstoned files are reclaimed every RECLAIM_INTERVAL seconds, RECLAIM_BATCH
+# at a time with RECLAIM_PAUSE seconds between batches
+RECLAIM_INTERVAL = float(os.environ.get("RECLAIM_INTERVAL", 10))
+RECLAIM_BATCH = int(os.environ.get("RECLAIM_BATCH", 100))
+RECLAIM_PAUSE = float(os.environ.get("RECLAIM_PAUSE", 0.5))
+# Most ids one POST /delete may name
+BULK_DELETE_MAX_IDS = int(os.environ.get("BULK_DELETE_MAX_IDS", 1000))
+
+# GET /files pagination
+FILES_PAGE_SIZE = int(os.environ.get("FILES_PAGE_SIZE", 100))
+FILES_PAGE_MAX = int(os.environ.get("FILES_PAGE_MAX", 1000))
+
+# Structured request logs (one JSON line per request) and slow-request profiling
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+# Sample the stacks of this fraction of requests and report those slower than
+# PROFILE_SLOW_REQUEST_MS (0 disables profiling)
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get("PROFILE_SLOW_REQUEST_MS", 0))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.01))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+
+# Seconds GET /readyz waits for a pooled connection before reporting not ready
+READY_TIMEOUT = float(os.environ.get("READY_TIMEOUT", 1))
+
+# Sessions: login reuses the oldest of this many slots per user
+MAX_SESSIONS_PER_USER = int(os.environ.get("MAX_SESSIONS_PER_USER", 1))
+SESSION_LIFETIME = int(os.environ.get("SESSION_LIFETIME", 3600))
+# Expired sessions are deleted in batches of SESSION_SWEEP_BATCH every SESSION_SWEEP_INTERVAL seconds
+SESSION_SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", 300))
+SESSION_SWEEP_BATCH = int(os.environ.get("SESSION_SWEEP_BATCH", 500))
+SESSION_SWEEP_PAUSE = float(os.environ.get("SESSION_SWEEP_PAUSE", 0.1))
+
+
+def validate():
+    """Check the settings above once, at import, so a typo fails fast instead of mid-request."""
+    choices = {
+        "HASH_EXECUTOR": ("thread", "process"),
+        "STORAGE_BACKEND": ("database", "disk"),
+        "STORAGE_COMPRESSION": ("none", "gzip", "zstd"),
+        "TOKEN_VERIFICATION": ("database", "stateless"),
+    }
+    for name, allowed in choices.items():
+        if globals()[name] not in allowed:
+            raise ConfigError(f"{name} must be one of {', '.join(allowed)}, got {globals()[name]!r}")
+    positive = (
+        "DB_POOL_MAX", "DB_BACKGROUND_POOL_MAX", "HASH_WORKERS", "UPLOAD_CHUNK_SIZE", "UPLOAD_MAX_SIZE", "DOWNLOAD_BATCH_CHUNKS",
+        "FILES_PAGE_SIZE", "FILES_PAGE_MAX", "MAX_SESSIONS_PER_USER", "SESSION_LIFETIME", "SESSION_SWEEP_BATCH",
+        "SNIFF_BYTES", "INDEX_INTERVAL", "INDEX_BATCH", "INDEX_CLAIM_TIMEOUT",
+        "RECLAIM_INTERVAL", "RECLAIM_BATCH", "BULK_DELETE_MAX_IDS", "UPLOAD_FALLBACK_TIMEOUT",
+    )
+    for name in positive:
+        if globals()[name] <= 0:
+            raise ConfigError(f"{name} must be positive, got {globals()[name]!r}")
+    for name in ("QUOTA_BYTES", "QUOTA_FILES"):
+        if globals()[name] < 0:
+            raise ConfigError(f"{name} must not be negative, got {globals()[name]!r}")
+    if not 0 <= DB_POOL_MIN <= DB_POOL_MAX:
+        raise ConfigError(f"DB_POOL_MIN must be between 0 and DB_POOL_MAX, got {DB_POOL_MIN}")
+    if not 0 < REVOCATION_ERROR_RATE < 1:
+        raise ConfigError(f"REVOCATION_ERROR_RATE must be between 0 and 1, got {REVOCATION_ERROR_RATE}")
+
+
+validate()
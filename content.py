@@ -0,0 +1,165 @@
+import csv
+import io
+import itertools
+
+from psycopg2.extras import Json
+
+import background
+import compression
+import config
+import db
+import instrumentation
+import serving
+import storage
+
+OCTET_STREAM = "application/octet-stream"
+CSV_DELIMITERS = ",;\t|"
+# Bytes that occur in text files: printable ASCII, anything 8-bit and the usual control characters
+TEXT_BYTES = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f})
+
+
+def sniff_type(head, file_name=None, declared=None):
+    """Detect the type of an upload from its first bytes.
+
+    PDFs are recognized by their signature and anything else must look like
+    text. Text is CSV when the client says so, by type or by a ``.csv``
+    name, or when its first lines parse as a table of two or more columns,
+    and plain text otherwise. Binary content is application/octet-stream,
+    which no upload accepts.
+    """
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    if head.translate(None, TEXT_BYTES):
+        return OCTET_STREAM
+    if declared == "text/csv" or (file_name or "").lower().endswith(".csv"):
+        return "text/csv"
+    if _looks_tabular(head.decode("utf-8", errors="replace")):
+        return "text/csv"
+    return "text/plain"
+
+
+def _looks_tabular(text):
+    lines = text.splitlines()
+    if len(lines) > 1 and not text.endswith(("\n", "\r")):
+        lines.pop()  # cut off by the end of the head
+    lines = lines[:20]
+    if len(lines) < 2:
+        return False
+    try:
+        dialect = csv.Sniffer().sniff("\n".join(lines), delimiters=CSV_DELIMITERS)
+    except csv.Error:
+        return False
+    widths = {len(row) for row in csv.reader(lines, dialect)}
+    return len(widths) == 1 and widths.pop() > 1
+
+
+class _ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterator of byte strings."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def index_csv(chunks, preview_rows):
+    """Header, data row count and first ``preview_rows`` data rows of CSV content.
+
+    The content is parsed in one streaming pass, so memory use does not
+    depend on its size. The dialect is sniffed from the first SNIFF_BYTES.
+    """
+    text = io.TextIOWrapper(
+        io.BufferedReader(_ChunkStream(chunks), config.UPLOAD_CHUNK_SIZE),
+        encoding="utf-8-sig", errors="replace", newline="",
+    )
+    sample = text.read(config.SNIFF_BYTES)
+    sample += text.readline()  # finish the last sampled line
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=CSV_DELIMITERS)
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(itertools.chain(io.StringIO(sample, newline=""), text), dialect)
+    columns = next(reader, [])
+    preview = list(itertools.islice(reader, preview_rows))
+    row_count = len(preview) + sum(1 for _ in reader)
+    return {"row_count": row_count, "columns": columns, "preview": preview}
+
+
+def queue_index(cursor, sha256):
+    """Queue a blob for indexing in the caller's transaction; a no-op if it already was."""
+    cursor.execute("INSERT INTO BLOB_INDEX (sha256) VALUES (%s) ON CONFLICT (sha256) DO NOTHING", (sha256,))
+
+
+def index_pending():
+    """Claim up to INDEX_BATCH queued blobs, index them and store the results.
+
+    Claims are committed before any content is read, so no transaction or
+    row lock is held while parsing, and SKIP LOCKED lets every worker of
+    every service drain the queue at once. Returns the number claimed.
+    """
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE BLOB_INDEX i SET status = 'running', claimed_at = now()
+            FROM BLOBS b
+            WHERE b.sha256 = i.sha256 AND i.sha256 IN (
+                SELECT sha256 FROM BLOB_INDEX
+                WHERE status = 'pending'
+                   OR (status = 'running' AND claimed_at < now() - make_interval(secs => %s))
+                ORDER BY queued_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING i.sha256, COALESCE(b.stored_size, b.size), b.chunk_size, b.storage_path, b.codec
+        """, (config.INDEX_CLAIM_TIMEOUT, config.INDEX_BATCH))
+        claimed = cursor.fetchall()
+        conn.commit()
+
+    for sha256, stored_size, chunk_size, storage_path, codec in claimed:
+        try:
+            with instrumentation.span("index.csv"):
+                chunks = storage.iter_blob(sha256, stored_size, chunk_size, storage_path)
+                if codec:
+                    chunks = compression.decompress(chunks, codec)
+                result = index_csv(chunks, config.CSV_PREVIEW_ROWS)
+        except Exception as e:
+            instrumentation.log.exception("Indexing blob %s failed", sha256)
+            query = "UPDATE BLOB_INDEX SET status = 'failed', error = %s, indexed_at = now() WHERE sha256 = %s"
+            params = (str(e), sha256)
+        else:
+            query = """
+                UPDATE BLOB_INDEX
+                SET status = 'done', row_count = %s, columns = %s, preview = %s, error = NULL, indexed_at = now()
+                WHERE sha256 = %s
+            """
+            params = (result["row_count"], Json(result["columns"]), Json(result["preview"]), sha256)
+        # A blob deleted meanwhile took its BLOB_INDEX row with it, so this may update nothing
+        with db.connection() as conn:
+            conn.cursor().execute(query, params)
+            conn.commit()
+    return len(claimed)
+
+
+def run_indexer():
+    while index_pending() == config.INDEX_BATCH:
+        pass
+
+
+@serving.on_worker_start
+def start_indexer():
+    indexer = background.PeriodicWorker("csv-indexer", config.INDEX_INTERVAL, run_indexer)
+    indexer.start()
+    serving.on_worker_exit(indexer.stop)
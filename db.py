@@ -0,0 +1,253 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+import config
+import instrumentation
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection became available within the pool timeout."""
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of psycopg2 connections.
+
+    Connections are opened lazily up to ``maxconn``. Once the pool is full,
+    callers wait up to ``timeout`` seconds for a connection to be returned.
+    Connections that sat idle longer than ``check_idle`` seconds are pinged
+    before being handed out, and broken ones are replaced transparently.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, check_idle, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, returned_at) pairs, most recent last
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "connections_opened": 0,
+            "connections_discarded": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        with instrumentation.span("db.connect"):
+            conn = psycopg2.connect(**self.connect_kwargs)
+        with self._cond:
+            self._stats["connections_opened"] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._stats["connections_discarded"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        """Check out a connection, waiting up to ``timeout`` (default: the pool's) seconds."""
+        with instrumentation.span("db.checkout"):
+            return self._getconn(self.timeout if timeout is None else timeout)
+
+    def _getconn(self, timeout):
+        start = time.monotonic()
+        deadline = start + timeout
+        conn = None
+        returned_at = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed.")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    # Reserve a slot; the connection is opened outside the lock.
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["checkout_failures"] += 1
+                    raise PoolTimeout(
+                        "Timed out after %.1fs waiting for a database connection." % timeout
+                    )
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif not self._is_healthy(conn, returned_at):
+                self._discard(conn)
+                conn = None
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._stats["checkout_failures"] += 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._stats["checkouts"] += 1
+            self._stats["wait_time_total"] += waited
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+        return conn
+
+    def putconn(self, conn):
+        """Return a connection, rolling back anything left uncommitted."""
+        discard = self._closed or bool(conn.closed)
+        if not discard:
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+
+        if discard:
+            self._discard(conn)
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that always hands the connection back to the pool.
+
+        Uncommitted work is rolled back on return, so handlers only need to
+        call ``conn.commit()`` on success.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def metrics(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+            })
+        stats["wait_time_avg"] = stats["wait_time_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# Set by processes that serve requests from another pool (auth_upload_async.py)
+# so this one only takes what their background threads need
+_pool_max = None
+
+
+def limit_pool(maxconn):
+    """Cap the process-wide pool below DB_POOL_MAX; call before its first use."""
+    global _pool_max
+    _pool_max = maxconn
+
+
+def get_pool():
+    """Return the process-wide pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                maxconn = min(config.DB_POOL_MAX, _pool_max or config.DB_POOL_MAX)
+                _pool = ConnectionPool(
+                    min(config.DB_POOL_MIN, maxconn),
+                    maxconn,
+                    config.DB_POOL_TIMEOUT,
+                    config.DB_POOL_CHECK_IDLE,
+                    dbname=config.DATABASE_CONFIG["dbname"],
+                    user=config.DATABASE_CONFIG["user"],
+                    password=config.DATABASE_CONFIG["password"],
+                    host=config.DATABASE_CONFIG["host"],
+                    port=config.DATABASE_CONFIG["port"],
+                    connection_factory=instrumentation.TimedConnection,
+                )
+    return _pool
+
+
+def connection():
+    """Shortcut for ``get_pool().connection()``."""
+    return get_pool().connection()
+
+
+def pool_metrics():
+    return get_pool().metrics()
+
+
+def check(timeout):
+    """Round-trip ``SELECT 1`` on a pooled connection; raises on any failure."""
+    pool = get_pool()
+    conn = pool.getconn(timeout)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+    finally:
+        pool.putconn(conn)
+
+
+def close_pool():
+    """Close the process-wide pool; the next get_pool() opens a fresh one."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.closeall()
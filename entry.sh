@@ -1,4 +1,25 @@
 #!/bin/bash
-sudo nohup python3 auth.py > auth.log 2>&1 &
-sudo nohup python3 auth_upload.py > upload.log 2>&1 &
-sudo nohup python3 auth_app.py > app.log 2>&1 &
+# Production start: apply migrations once, then serve each app with gunicorn
+# (settings in gunicorn.conf.py, WEB_* environment variables override them;
+# config.py reads the rest of the environment in every worker).
+# SIGTERM drains in-flight requests for up to WEB_GRACEFUL_TIMEOUT seconds;
+# SIGHUP reloads workers gracefully.
+# Nothing here needs root, and sudo would reset the environment these
+# settings come from.
+python3 manage.py migrate || exit 1
+if [ "$UPLOAD_SERVER" = "async" ]; then
+    # auth, the async upload service and its Flask fallback share the database budget
+    export WEB_SERVICES="${WEB_SERVICES:-3}"
+fi
+nohup gunicorn -c gunicorn.conf.py --bind 0.0.0.0:5001 'auth:create_app()' > auth.log 2>&1 &
+if [ "$UPLOAD_SERVER" = "async" ]; then
+    # asyncio implementation on 5002. It forwards what it does not implement
+    # (GET /files/<id> and POST /upload/batch) to the Flask service, which
+    # then only listens locally, on UPLOAD_FALLBACK_URL's port.
+    nohup gunicorn -c gunicorn.conf.py --bind 0.0.0.0:5002 --worker-class aiohttp.GunicornWebWorker \
+        'auth_upload_async:create_app()' > upload.log 2>&1 &
+    nohup gunicorn -c gunicorn.conf.py --bind 127.0.0.1:5003 'auth_upload:create_app()' > upload-fallback.log 2>&1 &
+else
+    nohup gunicorn -c gunicorn.conf.py --bind 0.0.0.0:5002 'auth_upload:create_app()' > upload.log 2>&1 &
+fi
+nohup gunicorn -c gunicorn.conf.py --bind 0.0.0.0:9000 'auth_app:create_server()' > app.log 2>&1 &
@@ -0,0 +1,78 @@
+import base64
+import binascii
+import datetime
+import json
+
+import config
+
+# Shared by the Flask (auth_upload.py) and asyncio (auth_upload_async.py) upload services
+
+ALLOWED_TYPES = ["application/pdf", "text/plain", "text/csv"]
+
+# Fields GET /files can return, mapped to the SQL that produces them
+FILE_FIELDS = {
+    "id": "id",
+    "file_name": "file_name",
+    "file_type": "file_type",
+    "file_size": "file_size",
+    "sha256": "blob_sha256 AS sha256",
+    "uploaded_at": "uploaded_at",
+    # CSV metadata from BLOB_INDEX, null until the indexer has processed the file
+    "index_status": "i.status AS index_status",
+    "row_count": "i.row_count",
+    "columns": "i.columns",
+    "preview": "i.preview",
+}
+INDEX_FIELDS = {"index_status", "row_count", "columns", "preview"}
+DEFAULT_FILE_FIELDS = ["id", "file_name", "file_type", "uploaded_at"]
+
+
+def files_source(fields):
+    """FROM clause for listing ``fields``, joining BLOB_INDEX only when one of them needs it."""
+    if INDEX_FIELDS.intersection(fields):
+        return "FILES LEFT JOIN BLOB_INDEX i ON i.sha256 = FILES.blob_sha256"
+    return "FILES"
+
+
+def encode_cursor(uploaded_at, file_id):
+    position = json.dumps([uploaded_at.isoformat(), file_id])
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(); raises ValueError for anything malformed."""
+    try:
+        uploaded_at, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.datetime.fromisoformat(uploaded_at), int(file_id)
+    except (TypeError, UnicodeError, binascii.Error, json.JSONDecodeError) as e:
+        raise ValueError(str(e))
+
+
+def _parse_time(body, key):
+    value = body.get(key)
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{key} must be an ISO 8601 date or time")
+
+
+def parse_bulk_delete(body):
+    """Validate a POST /delete body; returns (ids, uploaded_before, uploaded_after).
+
+    Any of them may be None, but not all three. Raises ValueError.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("expected a JSON object")
+    ids = body.get("ids")
+    if ids is not None:
+        if not isinstance(ids, list) or not all(type(file_id) is int for file_id in ids):
+            raise ValueError("ids must be a list of integers")
+        if len(ids) > config.BULK_DELETE_MAX_IDS:
+            raise ValueError(f"at most {config.BULK_DELETE_MAX_IDS} ids are allowed")
+    before = _parse_time(body, "uploaded_before")
+    after = _parse_time(body, "uploaded_after")
+    if ids is None and before is None and after is None:
+        raise ValueError("give ids, uploaded_before or uploaded_after")
+    return ids, before, after
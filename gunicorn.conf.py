@@ -0,0 +1,50 @@
+# Gunicorn settings shared by the services; see entry.sh. Every value can be
+# overridden per service on the command line (e.g. --workers 1).
+import multiprocessing
+import os
+
+bind = os.environ.get("WEB_BIND", "0.0.0.0:8000")
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+# Database connection budget: every worker of every service opens its own
+# pool, and together they must stay under the server's max_connections
+# (100 by default). WEB_SERVICES is how many of the services entry.sh starts
+# open connections: auth and upload, plus the Flask fallback with
+# UPLOAD_SERVER=async (auth_app only calls the others over HTTP). post_fork
+# splits DB_CONNECTION_BUDGET evenly between all their workers as
+# DB_POOL_MAX, and the default worker count is capped so each gets a
+# connection per thread. 90 leaves 10 for manage.py, psql and the like.
+services = int(os.environ.get("WEB_SERVICES", 2))
+db_connection_budget = int(os.environ.get("DB_CONNECTION_BUDGET", 90))
+workers = int(os.environ.get(
+    "WEB_WORKERS",
+    max(min(multiprocessing.cpu_count() * 2 + 1, db_connection_budget // (services * threads)), 1),
+))
+# Seconds a request may run before its worker is killed and replaced
+timeout = int(os.environ.get("WEB_TIMEOUT", 120))
+# Seconds in-flight requests get to finish after SIGTERM (or a SIGHUP reload)
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("WEB_KEEPALIVE", 5))
+# Recycle workers now and then so slow leaks cannot build up
+max_requests = int(os.environ.get("WEB_MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+
+# Each worker imports the app itself after the fork, so no database
+# connection, thread or executor is ever shared between processes.
+preload_app = False
+
+
+def post_fork(server, worker):
+    # Runs before the worker imports the app, so config picks this up;
+    # server.cfg.workers includes any --workers given on the command line
+    os.environ.setdefault("DB_POOL_MAX", str(max(db_connection_budget // (server.cfg.workers * services), 1)))
+
+
+def post_worker_init(worker):
+    import serving
+    serving.worker_started()
+
+
+def worker_exit(server, worker):
+    import serving
+    serving.worker_exiting()
@@ -0,0 +1,104 @@
+import itertools
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt
+
+import config
+import instrumentation
+
+
+class HashPoolSaturated(Exception):
+    """Raised when every hashing worker is busy and the queue is full."""
+
+
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _checkpw(password, password_hash):
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+
+def hash_rounds(password_hash):
+    """Return the cost factor encoded in a bcrypt hash such as ``$2b$12$...``."""
+    try:
+        return int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class HashPool:
+    """Runs bcrypt on a bounded executor so request threads only wait on it.
+
+    At most ``workers`` hashes run at once and up to ``queue_size`` more may
+    wait; anything beyond that raises HashPoolSaturated immediately instead
+    of piling up behind the CPU.
+    """
+
+    def __init__(self, workers, queue_size, executor="thread"):
+        if executor not in ("thread", "process"):
+            raise ValueError("HASH_EXECUTOR must be 'thread' or 'process', got %r" % executor)
+        self.workers = workers
+        self.executor_type = executor
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created on first use so forked server workers each get their own.
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.executor_type == "process":
+                        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    else:
+                        self._executor = ThreadPoolExecutor(
+                            max_workers=self.workers, thread_name_prefix="bcrypt"
+                        )
+        return self._executor
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashPoolSaturated()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+pool = HashPool(config.HASH_WORKERS, config.HASH_QUEUE_SIZE, config.HASH_EXECUTOR)
+
+
+@instrumentation.timed("hash")
+def hash_password(password):
+    return pool.run(_hashpw, password, config.BCRYPT_ROUNDS)
+
+
+@instrumentation.timed("hash")
+def check_password(password, password_hash):
+    return pool.run(_checkpw, password, password_hash)
+
+
+def hash_passwords(executor, passwords, rounds=None):
+    """Start hashing ``passwords`` on ``executor``; returns an iterator of the hashes in order.
+
+    For offline bulk jobs, which pass a ProcessPoolExecutor to use every
+    core; requests go through hash_password() and the bounded pool instead.
+    """
+    rounds = rounds or config.BCRYPT_ROUNDS
+    chunksize = max(1, len(passwords) // 64)
+    return executor.map(_hashpw, passwords, itertools.repeat(rounds, len(passwords)), chunksize=chunksize)
+
+
+def needs_rehash(password_hash):
+    """True when the hash was made with a cost other than BCRYPT_ROUNDS."""
+    return hash_rounds(password_hash) != config.BCRYPT_ROUNDS
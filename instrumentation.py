@@ -0,0 +1,260 @@
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+import flask
+from flask.json.provider import DefaultJSONProvider
+from psycopg2 import extensions
+
+import config
+
+log = logging.getLogger("peaches")
+
+# Prometheus' default latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Thread-safe cumulative histogram with one series per label set."""
+
+    def __init__(self, name, help, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labels, label_values))
+            prefix = labels + "," if labels else ""
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {values[-2]}')
+            lines.append(f"{self.name}_count{{{labels}}} {values[-2]}")
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-1]}")
+        return lines
+
+
+request_duration = Histogram(
+    "http_request_duration_seconds", "Time spent handling a request.",
+    ("service", "endpoint", "method", "status"),
+)
+span_duration = Histogram(
+    "span_duration_seconds", "Time spent in one part of a request (db, hashing, ...).",
+    ("service", "span"),
+)
+
+_service = "unknown"
+_gauges = []  # (prefix, callable returning {name: number})
+
+
+def register_gauges(prefix, collect):
+    """Export the numeric values of ``collect()`` as ``<prefix>_<name>`` gauges on /metrics."""
+    _gauges.append((prefix, collect))
+
+
+def render_metrics():
+    lines = request_duration.render() + span_duration.render()
+    for prefix, collect in _gauges:
+        try:
+            values = collect()
+        except Exception:
+            log.exception("Collecting %s metrics failed", prefix)
+            continue
+        for name, value in sorted(values.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# TYPE {prefix}_{name} gauge")
+                lines.append(f"{prefix}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block, both in the span histogram and on the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        span_duration.observe(elapsed, _service, name)
+        if flask.has_request_context():
+            spans = flask.g.setdefault("spans", {})
+            count, total = spans.get(name, (0, 0.0))
+            spans[name] = (count + 1, total + elapsed)
+
+
+def timed(name):
+    """Decorator form of span()."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+_cursor_classes = {}
+
+
+def _timed_cursor_class(base):
+    """Subclass of cursor class ``base`` whose queries are timed as db.<VERB> spans."""
+    cls = _cursor_classes.get(base)
+    if cls is None:
+        def execute(self, query, vars=None):
+            verb = query.split(None, 1)[0].upper() if isinstance(query, str) and query.strip() else "QUERY"
+            with span("db." + verb):
+                return base.execute(self, query, vars)
+
+        def executemany(self, query, vars_list):
+            with span("db.EXECUTEMANY"):
+                return base.executemany(self, query, vars_list)
+
+        cls = _cursor_classes[base] = type(
+            "Timed" + base.__name__, (base,), {"execute": execute, "executemany": executemany}
+        )
+    return cls
+
+
+class TimedConnection(extensions.connection):
+    """psycopg2 connection whose cursors, whatever their factory, time every query."""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory") or self.cursor_factory or extensions.cursor
+        kwargs["cursor_factory"] = _timed_cursor_class(factory)
+        return super().cursor(*args, **kwargs)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that records serialization time as a 'serialize' span."""
+
+    def dumps(self, obj, **kwargs):
+        with span("serialize"):
+            return super().dumps(obj, **kwargs)
+
+
+class StackSampler:
+    """Samples one thread's Python stack every ``interval`` seconds from a helper thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = traceback.extract_stack(frame)
+            self.samples[";".join(f"{f.filename.rsplit('/', 1)[-1]}:{f.name}" for f in stack)] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.samples
+
+
+def log_slow_request(record, samples):
+    """Default slow-request hook: log the most frequently sampled stacks (collapsed format)."""
+    log.warning(json.dumps(dict(record, event="slow_request", stacks=[
+        {"stack": stack, "samples": count} for stack, count in samples.most_common(10)
+    ])))
+
+
+# Called as hook(record, samples) for profiled requests slower than PROFILE_SLOW_REQUEST_MS
+slow_request_hooks = [log_slow_request]
+
+
+def init_app(app, service):
+    """Attach request IDs, timing, structured logs and GET /metrics to ``app``."""
+    global _service
+    _service = service
+    app.json = TimedJSONProvider(app)
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+        log.setLevel(config.LOG_LEVEL)
+        log.propagate = False
+
+    @app.before_request
+    def start_request():
+        flask.g.request_id = flask.request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        flask.g.started = time.perf_counter()
+        flask.g.sampler = None
+        if config.PROFILE_SLOW_REQUEST_MS > 0 and random.random() < config.PROFILE_SAMPLE_RATE:
+            flask.g.sampler = StackSampler(threading.get_ident(), config.PROFILE_INTERVAL).start()
+
+    @app.after_request
+    def finish_request(response):
+        started = flask.g.get("started")
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = flask.request.url_rule.rule if flask.request.url_rule else "<unmatched>"
+        request_duration.observe(elapsed, service, endpoint, flask.request.method, str(response.status_code))
+        response.headers["X-Request-ID"] = flask.g.request_id
+
+        record = {
+            "service": service,
+            "request_id": flask.g.request_id,
+            "method": flask.request.method,
+            "path": flask.request.path,
+            "status": response.status_code,
+            "duration_ms": round(elapsed * 1000, 3),
+            "spans": {
+                name: {"count": count, "ms": round(total * 1000, 3)}
+                for name, (count, total) in flask.g.get("spans", {}).items()
+            },
+        }
+        sampler = flask.g.pop("sampler", None)
+        if sampler is not None:
+            samples = sampler.stop()
+            if elapsed * 1000 >= config.PROFILE_SLOW_REQUEST_MS:
+                for hook in slow_request_hooks:
+                    hook(record, samples)
+        if endpoint != "/metrics":
+            log.info(json.dumps(record))
+        return response
+
+    @app.teardown_request
+    def stop_sampler(exc):
+        # after_request is skipped when a handler raises
+        sampler = flask.g.pop("sampler", None)
+        if sampler is not None:
+            sampler.stop()
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return flask.Response(render_metrics(), mimetype="text/plain; version=0.0.4")
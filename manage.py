@@ -0,0 +1,368 @@
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import os
+import sys
+import time
+
+from psycopg2.extras import RealDictCursor
+
+import compression
+import config
+import db
+import hashing
+import schema
+import storage
+
+
+def _legacy_content(file):
+    """Iterate over the content of a FILES row stored before blobs existed."""
+    size = file['file_size']
+    if file['inline']:
+        return storage.iter_inline(file['id'], 0, size, config.UPLOAD_CHUNK_SIZE)
+    if file['storage_path']:
+        return storage.iter_local(file['storage_path'], 0, size, config.UPLOAD_CHUNK_SIZE)
+    return storage.iter_file_chunks(file['id'], file['chunk_size'], 0, size)
+
+
+def migrate_file(file):
+    """Move one legacy file into the blob store. Returns True if it was migrated."""
+    if file['file_size'] is None:
+        return False
+    chunks = _legacy_content(file) if file['file_size'] else []
+    with storage.spool_chunks(chunks, float('inf')) as spooled:
+        if spooled.size != file['file_size']:
+            return False  # deleted or truncated while we were reading it
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT 1 FROM FILES WHERE id = %s AND blob_sha256 IS NULL FOR UPDATE",
+                (file['id'],)
+            )
+            if cursor.fetchone() is None:
+                return False
+            written = storage.store_blob(conn, spooled, config.UPLOAD_CHUNK_SIZE)
+            try:
+                cursor.execute("""
+                    UPDATE FILES
+                    SET blob_sha256 = %s, file_size = %s, storage_path = NULL, chunk_size = NULL
+                    WHERE id = %s
+                """, (spooled.sha256, spooled.size, file['id']))
+                cursor.execute("DELETE FROM FILE_CONTENTS WHERE file_id = %s", (file['id'],))
+                cursor.execute("DELETE FROM FILE_CHUNKS WHERE file_id = %s", (file['id'],))
+                with storage.removing([file['storage_path']]):
+                    conn.commit()
+            except BaseException:
+                if written:
+                    storage.remove_file(written)
+                raise
+    return True
+
+
+def compress_blob(blob, codec, level):
+    """Rewrite one raw blob compressed with ``codec``. Returns the stored size, or None if skipped."""
+    chunks = storage.iter_blob(blob['sha256'], blob['size'], blob['chunk_size'], blob['storage_path'])
+    with storage.spool_chunks(chunks, float('inf')) as spooled:
+        if spooled.sha256 != blob['sha256']:
+            return None  # deleted while we were reading it
+        spooled.compress(codec, level)
+        if not spooled.codec:
+            return None  # would not get any smaller
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT storage_path FROM BLOBS WHERE sha256 = %s AND codec IS NULL FOR UPDATE",
+                (blob['sha256'],)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            # Keep the blob on the backend it is on; a new path means a failed commit leaves the old file intact
+            storage_path = storage.blob_path(blob['sha256'], codec) if row[0] else None
+            if not storage_path:
+                cursor.execute("DELETE FROM BLOB_CHUNKS WHERE sha256 = %s", (blob['sha256'],))
+            written = storage.write_blob(conn, spooled, config.UPLOAD_CHUNK_SIZE, storage_path)
+            try:
+                cursor.execute("""
+                    UPDATE BLOBS SET codec = %s, stored_size = %s, chunk_size = %s, storage_path = %s
+                    WHERE sha256 = %s
+                """, (codec, spooled.stored_size, config.UPLOAD_CHUNK_SIZE, storage_path, blob['sha256']))
+                with storage.removing([row[0]]):
+                    conn.commit()
+            except BaseException:
+                if written:
+                    storage.remove_file(written)
+                raise
+    return spooled.stored_size
+
+
+def migrate(args):
+    """Apply pending schema migrations."""
+    schema.migrate()
+
+
+def migrate_blobs(args):
+    """Move file content stored in FILE_CONTENTS, FILE_CHUNKS or per file on disk into BLOBS."""
+    migrated = skipped = 0
+    last_id = 0
+    started = time.monotonic()
+    while True:
+        with db.connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute("""
+                SELECT id, file_size, chunk_size, storage_path,
+                       EXISTS (SELECT 1 FROM FILE_CONTENTS c WHERE c.file_id = FILES.id) AS inline
+                FROM FILES
+                WHERE blob_sha256 IS NULL AND deleted_at IS NULL AND id > %s
+                ORDER BY id
+                LIMIT %s
+            """, (last_id, args.batch_size))
+            files = cursor.fetchall()
+        if not files:
+            break
+        for file in files:
+            last_id = file['id']
+            if migrate_file(file):
+                migrated += 1
+            else:
+                skipped += 1
+        print(f"Migrated {migrated} files ({skipped} skipped) in {time.monotonic() - started:.1f}s")
+    print(f"Done: {migrated} files migrated, {skipped} skipped.")
+
+
+def compress_blobs(args):
+    """Compress raw blobs of text files stored before compression was enabled."""
+    compressed = skipped = 0
+    bytes_in = bytes_out = 0
+    last_sha256 = ''
+    started = time.monotonic()
+    while True:
+        with db.connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute("""
+                SELECT sha256, size, chunk_size, storage_path FROM BLOBS b
+                WHERE codec IS NULL AND sha256 > %s AND EXISTS (
+                    SELECT 1 FROM FILES f WHERE f.blob_sha256 = b.sha256 AND f.file_type = ANY(%s)
+                )
+                ORDER BY sha256
+                LIMIT %s
+            """, (last_sha256, sorted(compression.COMPRESSIBLE_TYPES), args.batch_size))
+            blobs = cursor.fetchall()
+        if not blobs:
+            break
+        for blob in blobs:
+            last_sha256 = blob['sha256']
+            stored_size = compress_blob(blob, args.codec, args.level)
+            if stored_size is None:
+                skipped += 1
+            else:
+                compressed += 1
+                bytes_in += blob['size']
+                bytes_out += stored_size
+        ratio = bytes_in / bytes_out if bytes_out else 0
+        print(f"Compressed {compressed} blobs ({skipped} skipped), {bytes_in} -> {bytes_out} bytes "
+              f"(ratio {ratio:.2f}) in {time.monotonic() - started:.1f}s")
+    print(f"Done: {compressed} blobs compressed, {skipped} skipped.")
+
+
+def recount_usage(args):
+    """Rebuild every user's USER_USAGE totals from their live files."""
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        # Lock out uploads and deletes, which update the totals, while they are rebuilt
+        cursor.execute("LOCK TABLE USER_USAGE IN EXCLUSIVE MODE")
+        cursor.execute("""
+            INSERT INTO USER_USAGE (user_id, bytes, files)
+            SELECT u.id, COALESCE(sum(f.file_size), 0), count(f.id)
+            FROM "USER" u LEFT JOIN FILES f ON f.user_id = u.id AND f.deleted_at IS NULL
+            GROUP BY u.id
+            ON CONFLICT (user_id) DO UPDATE SET bytes = EXCLUDED.bytes, files = EXCLUDED.files
+            WHERE (USER_USAGE.bytes, USER_USAGE.files) IS DISTINCT FROM (EXCLUDED.bytes, EXCLUDED.files)
+        """)
+        corrected = cursor.rowcount
+        conn.commit()
+    print(f"Corrected usage of {corrected} users.")
+
+
+IMPORT_COLUMNS = ("email", "username", "password")
+
+
+def _screen_users(batch, seen_emails, seen_usernames, reject):
+    """Drop rows that are incomplete, repeat an earlier row or name an existing user.
+
+    Returns the rows left, so no bcrypt time is spent on rows that cannot
+    be inserted.
+    """
+    candidates = []
+    for line, row in batch:
+        if not all(row.get(column) for column in IMPORT_COLUMNS):
+            reject(line, row, "missing email, username or password")
+        elif row['email'] in seen_emails:
+            reject(line, row, "email repeated in file")
+        elif row['username'] in seen_usernames:
+            reject(line, row, "username repeated in file")
+        else:
+            seen_emails.add(row['email'])
+            seen_usernames.add(row['username'])
+            candidates.append((line, row))
+    if not candidates:
+        return []
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT email, username FROM "USER" WHERE email = ANY(%s) OR username = ANY(%s)',
+            ([row['email'] for _, row in candidates], [row['username'] for _, row in candidates])
+        )
+        existing = cursor.fetchall()
+    emails = {email for email, _ in existing}
+    usernames = {username for _, username in existing}
+
+    accepted = []
+    for line, row in candidates:
+        reason = _conflict_reason(row['email'] in emails, row['username'] in usernames)
+        if reason:
+            reject(line, row, reason)
+        else:
+            accepted.append((line, row))
+    return accepted
+
+
+def _conflict_reason(email_taken, username_taken):
+    if email_taken and username_taken:
+        return "email and username already exist"
+    if email_taken:
+        return "email already exists"
+    if username_taken:
+        return "username already exists"
+    return None
+
+
+def _load_users(batch, hashes):
+    """Insert one batch of hashed users; returns the number inserted and the conflicting rows.
+
+    Rows are COPYed into a temporary table and moved into "USER" with ON
+    CONFLICT DO NOTHING, so a user registered meanwhile skips that row
+    instead of aborting the batch. Conflicts come back as
+    (line, email, username, email_taken, username_taken).
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for (line, row), password_hash in zip(batch, hashes):
+        writer.writerow((line, row['email'], row['username'], password_hash))
+    buffer.seek(0)
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TEMP TABLE user_import (
+                line INTEGER, email TEXT, username TEXT, password_hash TEXT
+            ) ON COMMIT DROP
+        """)
+        cursor.copy_expert("COPY user_import FROM STDIN WITH (FORMAT csv)", buffer)
+        # The outer SELECT does not see the CTE's inserts, so EXISTS only finds earlier users
+        cursor.execute("""
+            WITH inserted AS (
+                INSERT INTO "USER" (email, username, password_hash)
+                SELECT email, username, password_hash FROM user_import ORDER BY line
+                ON CONFLICT DO NOTHING
+                RETURNING email
+            )
+            SELECT s.line, s.email, s.username,
+                   EXISTS (SELECT 1 FROM "USER" u WHERE u.email = s.email),
+                   EXISTS (SELECT 1 FROM "USER" u WHERE u.username = s.username)
+            FROM user_import s
+            WHERE s.email NOT IN (SELECT email FROM inserted)
+            ORDER BY s.line
+        """)
+        conflicts = cursor.fetchall()
+        conn.commit()
+    return len(batch) - len(conflicts), conflicts
+
+
+def import_users(args):
+    """Create users in bulk from a CSV file with email, username and password columns."""
+    with open(args.report, "w", newline="") if args.report else contextlib.nullcontext(sys.stdout) as output:
+        _import_users(args, csv.writer(output))
+
+
+def _import_users(args, report):
+    from concurrent.futures import ProcessPoolExecutor
+
+    report.writerow(("line", "email", "username", "error"))
+    imported = rejected = 0
+
+    def reject(line, row, reason):
+        nonlocal rejected
+        rejected += 1
+        report.writerow((line, row.get('email'), row.get('username'), reason))
+
+    started = time.monotonic()
+    with open(args.file, newline="", encoding="utf-8-sig") as source, \
+            ProcessPoolExecutor(max_workers=args.workers) as executor:
+        reader = csv.DictReader(source)
+        missing = set(IMPORT_COLUMNS) - set(reader.fieldnames or ())
+        if missing:
+            sys.exit(f"{args.file} has no {', '.join(sorted(missing))} column")
+        rows = ((reader.line_num, row) for row in reader)
+        seen_emails, seen_usernames = set(), set()
+
+        # Each batch is hashed while the previous one is being loaded
+        pending = None
+        while True:
+            batch = list(itertools.islice(rows, args.batch_size))
+            if batch:
+                accepted = _screen_users(batch, seen_emails, seen_usernames, reject)
+                hashes = hashing.hash_passwords(executor, [row['password'] for _, row in accepted], args.rounds)
+            if pending:
+                count, conflicts = _load_users(*pending)
+                imported += count
+                for line, email, username, email_taken, username_taken in conflicts:
+                    reject(line, {"email": email, "username": username},
+                           _conflict_reason(email_taken, username_taken) or "conflicts with another user")
+                elapsed = time.monotonic() - started
+                print(f"Imported {imported} users ({rejected} rejected) in {elapsed:.1f}s, "
+                      f"{(imported + rejected) / elapsed:.0f} rows/s", file=sys.stderr)
+            if not batch:
+                break
+            pending = (accepted, hashes)
+    print(f"Done: {imported} users imported, {rejected} rejected.", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the file services.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("migrate", help=migrate.__doc__)
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser("migrate-blobs", help=migrate_blobs.__doc__)
+    command.add_argument("--batch-size", type=int, default=100)
+    command.set_defaults(func=migrate_blobs)
+
+    command = commands.add_parser("compress-blobs", help=compress_blobs.__doc__)
+    command.add_argument("--batch-size", type=int, default=100)
+    command.add_argument("--codec", choices=compression.CODECS,
+                         default=config.STORAGE_COMPRESSION if config.STORAGE_COMPRESSION != "none" else "gzip")
+    command.add_argument("--level", type=int, default=config.COMPRESSION_LEVEL)
+    command.set_defaults(func=compress_blobs)
+
+    command = commands.add_parser("recount-usage", help=recount_usage.__doc__)
+    command.set_defaults(func=recount_usage)
+
+    command = commands.add_parser("import-users", help=import_users.__doc__)
+    command.add_argument("file")
+    command.add_argument("--batch-size", type=int, default=1000)
+    command.add_argument("--workers", type=int, default=os.cpu_count(), help="hashing processes")
+    command.add_argument("--rounds", type=int, default=config.BCRYPT_ROUNDS)
+    command.add_argument("--report", help="write rejected rows to this CSV file instead of stdout")
+    command.set_defaults(func=import_users)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
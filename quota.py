@@ -0,0 +1,87 @@
+import config
+
+# Per-user storage counters live in USER_USAGE and change in the same
+# transaction as the FILES rows they count, so they never need a scan.
+# Sizes are the uploaded sizes, before deduplication or compression.
+
+
+class QuotaExceeded(Exception):
+    """Raised when an upload would take a user past QUOTA_BYTES or QUOTA_FILES."""
+
+
+def enabled():
+    return bool(config.QUOTA_BYTES or config.QUOTA_FILES)
+
+
+def exceeds(used_bytes, used_files):
+    return bool(
+        (config.QUOTA_BYTES and used_bytes > config.QUOTA_BYTES)
+        or (config.QUOTA_FILES and used_files > config.QUOTA_FILES)
+    )
+
+
+def remaining(used_bytes, used_files):
+    """(bytes, files) a user with this usage may still add, each None when unlimited."""
+    return (
+        max(config.QUOTA_BYTES - used_bytes, 0) if config.QUOTA_BYTES else None,
+        max(config.QUOTA_FILES - used_files, 0) if config.QUOTA_FILES else None,
+    )
+
+
+def available(cursor, user_id):
+    cursor.execute("SELECT bytes, files FROM USER_USAGE WHERE user_id = %s", (user_id,))
+    return remaining(*(cursor.fetchone() or (0, 0)))
+
+
+CHARGE = """
+    INSERT INTO USER_USAGE (user_id, bytes, files) VALUES (%s, %s, %s)
+    ON CONFLICT (user_id) DO UPDATE
+    SET bytes = USER_USAGE.bytes + EXCLUDED.bytes, files = USER_USAGE.files + EXCLUDED.files
+    RETURNING bytes, files
+"""
+
+
+def charge(cursor, user_id, size, files=1):
+    """Count new files in the caller's transaction, raising QuotaExceeded if they do not fit.
+
+    The row stays locked until commit, so concurrent uploads by one user are
+    checked one after another and cannot overshoot the quota together. Call
+    it last, just before committing, so the lock is held only that long.
+    """
+    cursor.execute(CHARGE, (user_id, size, files))
+    if exceeds(*cursor.fetchone()):
+        raise QuotaExceeded()
+
+
+def with_release(update):
+    """Wrap an UPDATE that tombstones FILES rows so the owners' usage drops in the same statement.
+
+    ``update`` must end in RETURNING with at least user_id and file_size;
+    the result has the rows it returns.
+    """
+    return f"""
+        WITH deleted AS ({update}), released AS (
+            UPDATE USER_USAGE u SET bytes = u.bytes - d.bytes, files = u.files - d.files
+            FROM (
+                SELECT user_id, COALESCE(sum(file_size), 0) AS bytes, count(*) AS files
+                FROM deleted GROUP BY user_id
+            ) d
+            WHERE u.user_id = d.user_id
+        )
+        SELECT * FROM deleted
+    """
+
+
+def usage(cursor, user_id):
+    cursor.execute("SELECT bytes, files FROM USER_USAGE WHERE user_id = %s", (user_id,))
+    return describe(*(cursor.fetchone() or (0, 0)))
+
+
+def describe(used_bytes, used_files):
+    """The GET /usage response body."""
+    return {
+        "bytes": used_bytes,
+        "files": used_files,
+        "quota_bytes": config.QUOTA_BYTES or None,
+        "quota_files": config.QUOTA_FILES or None,
+    }
@@ -0,0 +1,50 @@
+import time
+
+import background
+import config
+import db
+import serving
+import storage
+
+
+def reclaim_deleted():
+    """Remove tombstoned files and their content in small batches, committing after each one.
+
+    Each batch deletes up to RECLAIM_BATCH FILES rows (legacy FILE_CHUNKS and
+    FILE_CONTENTS rows go with them) and releases their blobs in sha256
+    order, the order uploads lock them in, then sleeps RECLAIM_PAUSE
+    seconds so reclaiming never competes with requests for long. Returns
+    the number of files reclaimed.
+    """
+    reclaimed = 0
+    while True:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SET LOCAL lock_timeout = '1s'")
+            cursor.execute("""
+                DELETE FROM FILES WHERE id IN (
+                    SELECT id FROM FILES
+                    WHERE deleted_at IS NOT NULL
+                    ORDER BY deleted_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING storage_path, blob_sha256
+            """, (config.RECLAIM_BATCH,))
+            files = cursor.fetchall()
+            garbage = [storage_path for storage_path, _ in files]
+            for sha256 in sorted(sha256 for _, sha256 in files if sha256):
+                garbage.append(storage.release_blob(conn, sha256))
+            with storage.removing(garbage):
+                conn.commit()
+        reclaimed += len(files)
+        if len(files) < config.RECLAIM_BATCH:
+            return reclaimed
+        time.sleep(config.RECLAIM_PAUSE)
+
+
+@serving.on_worker_start
+def start_reclaimer():
+    worker = background.PeriodicWorker("file-reclaimer", config.RECLAIM_INTERVAL, reclaim_deleted)
+    worker.start()
+    serving.on_worker_exit(worker.stop)
@@ -0,0 +1,207 @@
+import hashlib
+import math
+import threading
+
+import jwt
+from psycopg2.extras import RealDictCursor
+
+import background
+import config
+import db
+import instrumentation
+import serving
+import token_cache
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, sized for ``capacity`` items at ``error_rate``."""
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.sha256(item.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationList:
+    """In-memory view of REVOKED_TOKENS used by stateless token verification.
+
+    The Bloom filter is rebuilt from the database every
+    REVOCATION_REFRESH_INTERVAL seconds, which bounds how long a token
+    revoked by another process keeps working. A filter hit is confirmed
+    with an indexed lookup, so false positives cost one query and never
+    reject a valid token; misses, the common case, cost none.
+    """
+
+    def __init__(self):
+        self._filter = BloomFilter(config.REVOCATION_CAPACITY, config.REVOCATION_ERROR_RATE)
+        self._lock = threading.Lock()
+        self.refreshes = 0
+        self.lookups = 0
+        self.false_positives = 0
+
+    def refresh(self):
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT jti FROM REVOKED_TOKENS WHERE expires_at > now()")
+            jtis = [row[0] for row in cursor.fetchall()]
+        bloom = BloomFilter(max(config.REVOCATION_CAPACITY, len(jtis) * 2), config.REVOCATION_ERROR_RATE)
+        for jti in jtis:
+            bloom.add(jti)
+        with self._lock:
+            self._filter = bloom
+            self.refreshes += 1
+
+    def add(self, jti):
+        """Make a revocation done by this process visible here immediately."""
+        with self._lock:
+            self._filter.add(jti)
+
+    def might_be_revoked(self, jti):
+        return jti in self._filter
+
+    def confirmed(self, revoked):
+        """Count a database check of a filter hit and whether it was really revoked."""
+        with self._lock:
+            self.lookups += 1
+            self.false_positives += not revoked
+
+    def stats(self):
+        return {
+            "size": self._filter.count,
+            "capacity": self._filter.capacity,
+            "refreshes": self.refreshes,
+            "lookups": self.lookups,
+            "false_positives": self.false_positives,
+        }
+
+
+revoked = RevocationList()
+
+
+def revoke(cursor, jti, expires_at):
+    """Record a revocation in the caller's transaction; call revoked.add() after committing."""
+    cursor.execute(
+        "INSERT INTO REVOKED_TOKENS (jti, expires_at) VALUES (%s, %s) ON CONFLICT (jti) DO NOTHING",
+        (jti, expires_at)
+    )
+
+
+def stateless_user(claims):
+    """The USER fields carried in a token issued for stateless verification, or None."""
+    if "jti" not in claims or "username" not in claims:
+        return None
+    return {"id": claims["user_id"], "username": claims["username"]}
+
+
+class InvalidToken(Exception):
+    """A token failed verification; ``response`` is the body of the 401 to send."""
+
+    def __init__(self, message, error=None):
+        super().__init__(message)
+        self.response = {"message": message}
+        if error is not None:
+            self.response["error"] = error
+
+
+# Database lookups verification() asks its driver for, and their psycopg2 SQL
+USER_LOOKUP = "user"
+REVOKED_LOOKUP = "revoked"
+LOOKUPS = {
+    USER_LOOKUP: """
+        SELECT *, EXISTS (SELECT 1 FROM REVOKED_TOKENS WHERE jti = %s) AS revoked
+        FROM "USER" WHERE id = %s
+    """,
+    REVOKED_LOOKUP: "SELECT 1 FROM REVOKED_TOKENS WHERE jti = %s",
+}
+
+
+def verification(token, secret):
+    """The rules every token_required applies, as a generator shared by sync and asyncio code.
+
+    Yields ``(lookup, params)`` each time it needs the database and expects
+    the row found, as a dict, or None to be sent back. Returns the user
+    dict, or raises InvalidToken. verify_token() drives it with db.py;
+    auth_upload_async.py has an asyncpg driver.
+    """
+    stateless = config.TOKEN_VERIFICATION == "stateless"
+
+    # Tokens verified recently skip both the JWT decode and the USER lookup
+    cached = None if stateless else token_cache.cache.get(token)
+    if cached:
+        return cached[1]
+
+    try:
+        with instrumentation.span("jwt.decode"):
+            claims = jwt.decode(token, secret, algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        raise InvalidToken("Token has expired!")
+    except jwt.InvalidTokenError as e:
+        raise InvalidToken("Token is invalid!", str(e))
+
+    # The signed claims are enough unless the token was revoked; only filter hits are looked up
+    user = stateless_user(claims) if stateless else None
+    if user is not None:
+        if revoked.might_be_revoked(claims['jti']):
+            found = (yield REVOKED_LOOKUP, (claims['jti'],)) is not None
+            revoked.confirmed(found)
+            if found:
+                raise InvalidToken("Token has been revoked!")
+        return user
+
+    user = yield USER_LOOKUP, (claims.get('jti'), claims.get('user_id'))
+    if not user or user['revoked']:
+        raise InvalidToken("Invalid token!")
+
+    user = token_cache.trim_user(user)
+    token_cache.cache.put(token, claims, user)
+    return user
+
+
+def verify_token(token, secret):
+    """Run verification() on db.py's pool; returns ``(user, None)`` or ``(None, 401 body)``."""
+    steps = verification(token, secret)
+    try:
+        lookup, params = next(steps)
+        while True:
+            with instrumentation.span("auth.user_lookup"), db.connection() as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute(LOOKUPS[lookup], params)
+                row = cursor.fetchone()
+            lookup, params = steps.send(row)
+    except StopIteration as done:
+        return done.value, None
+    except InvalidToken as e:
+        return None, e.response
+
+
+@serving.on_worker_start
+def start_refresher():
+    if config.TOKEN_VERIFICATION != "stateless":
+        return
+    try:
+        revoked.refresh()
+    except Exception:
+        instrumentation.log.exception("Initial revocation list load failed; retrying in the background")
+    refresher = background.PeriodicWorker(
+        "revocation-refresher", config.REVOCATION_REFRESH_INTERVAL, revoked.refresh
+    )
+    refresher.start()
+    serving.on_worker_exit(refresher.stop)
+    instrumentation.register_gauges("revocation", revoked.stats)
@@ -0,0 +1,228 @@
+import db
+
+# Arbitrary key for pg_advisory_xact_lock so services starting together
+# don't apply the same migration twice.
+MIGRATION_LOCK_ID = 7301
+
+
+# (version, description, statements). Append new migrations to the end and
+# never edit one that has shipped. Statements are written to be no-ops on
+# databases created by the ad-hoc setup code that predates this module.
+MIGRATIONS = [
+    (1, "users and sessions", [
+        """
+        CREATE TABLE IF NOT EXISTS "USER" (
+            id SERIAL PRIMARY KEY,
+            email TEXT UNIQUE NOT NULL,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS "SESSION" (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            session_token TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES "USER" (id)
+        )
+        """,
+    ]),
+    (2, "files", [
+        """
+        CREATE TABLE IF NOT EXISTS FILES (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            file_data BYTEA NOT NULL,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (3, "streamed uploads", [
+        "ALTER TABLE FILES ALTER COLUMN file_data DROP NOT NULL",
+        "ALTER TABLE FILES ADD COLUMN IF NOT EXISTS file_size BIGINT",
+        "ALTER TABLE FILES ADD COLUMN IF NOT EXISTS chunk_size INTEGER",
+        "ALTER TABLE FILES ADD COLUMN IF NOT EXISTS storage_path TEXT",
+        """
+        UPDATE FILES SET file_size = octet_length(file_data)
+        WHERE file_size IS NULL AND file_data IS NOT NULL
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS FILE_CHUNKS (
+            file_id INTEGER NOT NULL REFERENCES FILES (id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            data BYTEA NOT NULL,
+            PRIMARY KEY (file_id, seq)
+        )
+        """,
+    ]),
+    (4, "content-addressed blobs", [
+        """
+        CREATE TABLE IF NOT EXISTS BLOBS (
+            sha256 TEXT PRIMARY KEY,
+            size BIGINT NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            storage_path TEXT,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS BLOB_CHUNKS (
+            sha256 TEXT NOT NULL REFERENCES BLOBS (sha256) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            data BYTEA NOT NULL,
+            PRIMARY KEY (sha256, seq)
+        )
+        """,
+        "ALTER TABLE FILES ADD COLUMN IF NOT EXISTS blob_sha256 TEXT REFERENCES BLOBS (sha256)",
+    ]),
+    # FILES becomes a narrow metadata table; the remaining inline BYTEA moves
+    # out so listing never touches TOASTed content. Space held by the dropped
+    # column is only returned once the rows are rewritten (VACUUM FULL FILES).
+    (5, "split file content from metadata", [
+        """
+        CREATE TABLE IF NOT EXISTS FILE_CONTENTS (
+            file_id INTEGER PRIMARY KEY REFERENCES FILES (id) ON DELETE CASCADE,
+            file_data BYTEA NOT NULL
+        )
+        """,
+        """
+        INSERT INTO FILE_CONTENTS (file_id, file_data)
+        SELECT id, file_data FROM FILES WHERE file_data IS NOT NULL
+        ON CONFLICT (file_id) DO NOTHING
+        """,
+        "ALTER TABLE FILES DROP COLUMN IF EXISTS file_data",
+        """
+        CREATE INDEX IF NOT EXISTS files_user_uploaded_idx
+        ON FILES (user_id, uploaded_at DESC, id DESC)
+        """,
+    ]),
+    # Logins upsert into one of MAX_SESSIONS_PER_USER slots instead of
+    # DELETE + INSERT, and expired rows are swept in the background.
+    (6, "indexed sessions with expiry", [
+        'ALTER TABLE "SESSION" ADD COLUMN IF NOT EXISTS slot INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE "SESSION" ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ',
+        """
+        UPDATE "SESSION" SET expires_at = created_at + interval '1 hour'
+        WHERE expires_at IS NULL
+        """,
+        'ALTER TABLE "SESSION" ALTER COLUMN expires_at SET NOT NULL',
+        """
+        DELETE FROM "SESSION" s USING "SESSION" newer
+        WHERE s.user_id = newer.user_id AND s.slot = newer.slot AND s.id < newer.id
+        """,
+        'CREATE UNIQUE INDEX IF NOT EXISTS session_user_slot_idx ON "SESSION" (user_id, slot)',
+        'CREATE INDEX IF NOT EXISTS session_expires_idx ON "SESSION" (expires_at)',
+        'CREATE INDEX IF NOT EXISTS session_token_idx ON "SESSION" USING hash (session_token)',
+    ]),
+    # Tokens carry a jti; rotated-out and logged-out ones are listed here so
+    # stateless verification can reject them without a per-request lookup.
+    (7, "token revocation", [
+        'ALTER TABLE "SESSION" ADD COLUMN IF NOT EXISTS jti TEXT',
+        'CREATE INDEX IF NOT EXISTS session_jti_idx ON "SESSION" (jti)',
+        """
+        CREATE TABLE IF NOT EXISTS REVOKED_TOKENS (
+            jti TEXT PRIMARY KEY,
+            expires_at TIMESTAMPTZ NOT NULL,
+            revoked_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS revoked_tokens_expires_idx ON REVOKED_TOKENS (expires_at)',
+    ]),
+    # Metadata extracted from CSV content after upload. Keyed by blob, so
+    # identical uploads are indexed once; rows double as the work queue.
+    (8, "csv index", [
+        """
+        CREATE TABLE IF NOT EXISTS BLOB_INDEX (
+            sha256 TEXT PRIMARY KEY REFERENCES BLOBS(sha256) ON DELETE CASCADE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            row_count BIGINT,
+            columns JSONB,
+            preview JSONB,
+            error TEXT,
+            queued_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            claimed_at TIMESTAMPTZ,
+            indexed_at TIMESTAMPTZ
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS blob_index_queue_idx ON BLOB_INDEX (queued_at) WHERE status IN ('pending', 'running')",
+    ]),
+    # Blobs may be stored compressed; codec NULL means raw, and stored_size
+    # (the compressed length) defaults to size for rows written before this.
+    (9, "blob compression", [
+        "ALTER TABLE BLOBS ADD COLUMN IF NOT EXISTS codec TEXT",
+        "ALTER TABLE BLOBS ADD COLUMN IF NOT EXISTS stored_size BIGINT",
+    ]),
+    # Deleting a file only sets deleted_at; the reclaimer removes tombstoned
+    # rows and their content later. Listing only ever reads live rows.
+    (10, "file tombstones", [
+        "ALTER TABLE FILES ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ",
+        """
+        CREATE INDEX IF NOT EXISTS files_user_live_idx
+        ON FILES (user_id, uploaded_at DESC, id DESC) WHERE deleted_at IS NULL
+        """,
+        "DROP INDEX IF EXISTS files_user_uploaded_idx",
+        "CREATE INDEX IF NOT EXISTS files_deleted_idx ON FILES (deleted_at) WHERE deleted_at IS NOT NULL",
+    ]),
+    # Per-user totals over live FILES rows, kept up to date by uploads and
+    # deletes in the same transaction; "manage.py recount-usage" rebuilds them.
+    (11, "user storage usage", [
+        """
+        CREATE TABLE IF NOT EXISTS USER_USAGE (
+            user_id INTEGER PRIMARY KEY REFERENCES "USER" (id) ON DELETE CASCADE,
+            bytes BIGINT NOT NULL DEFAULT 0,
+            files INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO USER_USAGE (user_id, bytes, files)
+        SELECT user_id, COALESCE(sum(file_size), 0), count(*)
+        FROM FILES WHERE deleted_at IS NULL
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET bytes = EXCLUDED.bytes, files = EXCLUDED.files
+        """,
+    ]),
+    (12, "index files by blob", [
+        # Deleting a BLOBS row checks FILES for references, as does compress-blobs
+        "CREATE INDEX IF NOT EXISTS files_blob_idx ON FILES (blob_sha256)",
+    ]),
+]
+
+
+def applied_versions(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SCHEMA_MIGRATIONS (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT version FROM SCHEMA_MIGRATIONS")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(verbose=True):
+    """Apply every pending migration, each in its own transaction. Safe to run repeatedly."""
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            if version in applied_versions(cursor):
+                conn.commit()
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(
+                "INSERT INTO SCHEMA_MIGRATIONS (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            conn.commit()
+        applied.append(version)
+        if verbose:
+            print(f"Applied migration {version}: {description}")
+    return applied
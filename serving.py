@@ -0,0 +1,66 @@
+import threading
+
+from flask import jsonify
+
+import config
+import db
+import hashing
+import instrumentation
+
+_start_hooks = []
+_exit_hooks = []
+_started = False
+_started_lock = threading.Lock()
+
+
+def on_worker_start(f):
+    """Register ``f`` to run in each server worker once it has forked, before it serves requests."""
+    _start_hooks.append(f)
+    return f
+
+
+def on_worker_exit(f):
+    """Register ``f`` to run when a worker shuts down; hooks run in reverse order."""
+    _exit_hooks.append(f)
+    return f
+
+
+def worker_started():
+    """Run the start hooks; only the first call in a process does anything.
+
+    gunicorn's post_worker_init and the asyncio service's on_startup both
+    call this, and background threads must not be started twice.
+    """
+    global _started
+    with _started_lock:
+        if _started:
+            return
+        _started = True
+    for hook in _start_hooks:
+        hook()
+
+
+def worker_exiting():
+    for hook in reversed(_exit_hooks):
+        try:
+            hook()
+        except Exception:
+            instrumentation.log.exception("Shutdown hook %s failed", hook.__name__)
+    hashing.pool.shutdown()
+    db.close_pool()
+
+
+def init_app(app):
+    """Add GET /healthz (liveness) and GET /readyz (database reachable) to ``app``."""
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({"status": "ok"}), 200
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        try:
+            db.check(config.READY_TIMEOUT)
+        except Exception as e:
+            return jsonify({"status": "unavailable", "error": str(e)}), 503
+        return jsonify({"status": "ok", "pool": db.pool_metrics()}), 200
@@ -0,0 +1,115 @@
+"""Cold-start benchmark for the services.
+
+Each run starts a fresh interpreter that imports one service, builds its app
+with create_app() and serves one request through the test client, timing
+the three steps. Medians over ``--runs`` runs are reported per service and
+can be written to JSON and compared with an earlier result, like bench.py.
+``--profile`` also prints the slowest imports from ``python -X importtime``.
+No database is needed: the probed endpoints never open a connection.
+
+    python startup_bench.py --runs 10 --output startup.json
+    python startup_bench.py --compare startup.json --profile
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+from bench import git_commit
+
+# module -> (expression building the WSGI app, path requested once it is built)
+SERVICES = {
+    "auth": ("auth.create_app()", "/healthz"),
+    "auth_upload": ("auth_upload.create_app()", "/healthz"),
+    "auth_app": ("auth_app.create_server()", "/"),
+}
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+app = {factory}
+created = time.perf_counter()
+status = app.test_client().get({path!r}).status_code
+served = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - started) * 1000,
+    "create_ms": (created - imported) * 1000,
+    "first_request_ms": (served - created) * 1000,
+    "status": status,
+}}))
+"""
+
+
+def run_once(module, profile=False):
+    factory, path = SERVICES[module]
+    command = [sys.executable]
+    if profile:
+        command += ["-X", "importtime"]
+    command += ["-c", PROBE.format(module=module, factory=factory, path=path)]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{module} failed to start:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_log, count):
+    """Top ``count`` (cumulative microseconds, module) pairs from -X importtime output."""
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure service import, app creation and first request time.")
+    parser.add_argument("services", nargs="*", help=f"any of {', '.join(SERVICES)} (default: all)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--profile", action="store_true", help="print the slowest imports")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="show changes against a previous JSON result")
+    args = parser.parse_args()
+    # Checked here: argparse rejects an empty nargs="*" list when given choices
+    unknown = set(args.services) - set(SERVICES)
+    if unknown:
+        parser.error(f"unknown services: {', '.join(sorted(unknown))}")
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file).get("services", {})
+
+    services = {}
+    for module in args.services or SERVICES:
+        runs = [run_once(module)[0] for _ in range(args.runs)]
+        stats = {
+            key: statistics.median(run[key] for run in runs)
+            for key in ("import_ms", "create_ms", "first_request_ms")
+        }
+        stats["total_ms"] = sum(stats.values())
+        stats["status"] = runs[-1]["status"]
+        services[module] = stats
+
+        line = (f"{module:<12} import {stats['import_ms']:8.1f} ms  create {stats['create_ms']:7.1f} ms  "
+                f"first request {stats['first_request_ms']:7.1f} ms  total {stats['total_ms']:8.1f} ms")
+        before = baseline.get(module)
+        if before and before["total_ms"]:
+            line += f"   ({(stats['total_ms'] - before['total_ms']) / before['total_ms'] * 100:+.0f}%)"
+        print(line)
+
+        if args.profile:
+            for cumulative, name in slowest_imports(run_once(module, profile=True)[1], 15):
+                print(f"    {cumulative / 1000:8.1f} ms  {name}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"commit": git_commit(), "runs": args.runs, "services": services}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
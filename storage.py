@@ -0,0 +1,356 @@
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+
+import psycopg2
+
+import compression
+import config
+import db
+
+
+class FileTooLarge(Exception):
+    """Raised when an upload grows past the configured maximum size."""
+
+
+def read_chunks(stream, chunk_size):
+    """Yield ``chunk_size`` byte blocks from ``stream`` (the last one may be shorter).
+
+    Short reads from the underlying socket are coalesced so every chunk but
+    the last has exactly ``chunk_size`` bytes, which keeps byte offsets and
+    chunk numbers trivially convertible.
+    """
+    buffer = bytearray()
+    while True:
+        data = stream.read(chunk_size - len(buffer))
+        if not data:
+            break
+        buffer += data
+        if len(buffer) == chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def local_path(storage_path):
+    """Absolute path of a storage_path, which is relative to STORAGE_DIR."""
+    return os.path.join(os.path.abspath(config.STORAGE_DIR), storage_path)
+
+
+def blob_path(sha256, codec=None):
+    """Relative on-disk location of a content-addressed blob."""
+    path = f"blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}"
+    return f"{path}.{codec}" if codec else path
+
+
+class SpooledUpload:
+    """Upload content staged in a temporary file, with its digest, size and first bytes.
+
+    Use as a context manager; the temporary file is removed on exit unless
+    it was moved into the blob store.
+    """
+
+    def __init__(self, path, sha256, size, head=b""):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.head = head
+        # What the file at ``path`` holds: the content as is, unless compress() changed it
+        self.codec = None
+        self.stored_size = size
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def compress(self, codec, level):
+        """Replace the staged file with a ``codec``-compressed copy.
+
+        Runs before a connection is borrowed, so the CPU cost is never paid
+        while holding one. The raw file is kept if compression would not
+        make it smaller. ``sha256`` and ``size`` still describe the
+        original content.
+        """
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".part")
+        stored_size = 0
+        try:
+            with os.fdopen(fd, "wb") as target, self.open() as source:
+                for data in compression.compress(read_chunks(source, config.UPLOAD_CHUNK_SIZE), codec, level):
+                    target.write(data)
+                    stored_size += len(data)
+        except BaseException:
+            os.remove(path)
+            raise
+        if stored_size >= self.size:
+            os.remove(path)
+            return
+        os.remove(self.path)
+        self.path = path
+        self.codec = codec
+        self.stored_size = stored_size
+
+    def close(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Spooler:
+    """Incremental form of spool_chunks() for callers that receive data piecemeal.
+
+    Call write() for each piece and finish() at the end; abort() (or any
+    exception from write()) removes the temporary file.
+    """
+
+    def __init__(self, max_size):
+        directory = None
+        if config.STORAGE_BACKEND == "disk":
+            directory = local_path("tmp")
+            os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+        self._digest = hashlib.sha256()
+        self._head = bytearray()
+        self.max_size = max_size
+        self.size = 0
+
+    def write(self, chunk):
+        try:
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                raise FileTooLarge()
+            self._digest.update(chunk)
+            if len(self._head) < config.SNIFF_BYTES:
+                self._head += chunk[:config.SNIFF_BYTES - len(self._head)]
+            self._file.write(chunk)
+        except BaseException:
+            self.abort()
+            raise
+
+    def finish(self):
+        self._file.close()
+        return SpooledUpload(self.path, self._digest.hexdigest(), self.size, bytes(self._head))
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def spool_chunks(chunks, max_size):
+    """Write ``chunks`` to a temporary file while hashing and counting them.
+
+    The first SNIFF_BYTES bytes are kept on the result as ``head`` so the
+    content type can be detected without reading the file again.
+
+    Raises FileTooLarge as soon as more than ``max_size`` bytes arrive. For
+    the disk backend the file is created inside STORAGE_DIR so it can later
+    be renamed into the blob store without copying.
+    """
+    spooler = Spooler(max_size)
+    try:
+        for chunk in chunks:
+            spooler.write(chunk)
+    except BaseException:
+        spooler.abort()
+        raise
+    return spooler.finish()
+
+
+def spool(stream, chunk_size, max_size):
+    """Stage ``stream`` in a temporary file; see spool_chunks()."""
+    return spool_chunks(read_chunks(stream, chunk_size), max_size)
+
+
+def store_blob(conn, spooled, chunk_size):
+    """Take a reference on the blob holding ``spooled``'s content, storing it if new.
+
+    Returns the storage_path written to local disk, or None when nothing was
+    written there (the blob already existed, or it went into BLOB_CHUNKS).
+    Concurrent uploads of the same new content serialize on the BLOBS row,
+    so the content is written once. The caller must commit.
+    """
+    storage_path = blob_path(spooled.sha256, spooled.codec) if config.STORAGE_BACKEND == "disk" else None
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO BLOBS (sha256, size, chunk_size, storage_path, refcount, codec, stored_size)
+        VALUES (%s, %s, %s, %s, 1, %s, %s)
+        ON CONFLICT (sha256) DO UPDATE SET refcount = BLOBS.refcount + 1
+        RETURNING (xmax = 0) AS inserted
+    """, (spooled.sha256, spooled.size, chunk_size, storage_path, spooled.codec, spooled.stored_size))
+    if not cursor.fetchone()[0]:
+        return None  # identical content is already stored
+    return write_blob(conn, spooled, chunk_size, storage_path)
+
+
+def write_blob(conn, spooled, chunk_size, storage_path):
+    """Put the staged file of ``spooled`` at ``storage_path``, or into BLOB_CHUNKS when that is None."""
+    if storage_path:
+        return move_blob(spooled, storage_path)
+
+    cursor = conn.cursor()
+    with spooled.open() as source:
+        for seq, chunk in enumerate(read_chunks(source, chunk_size)):
+            cursor.execute(
+                "INSERT INTO BLOB_CHUNKS (sha256, seq, data) VALUES (%s, %s, %s)",
+                (spooled.sha256, seq, psycopg2.Binary(chunk))
+            )
+    return None
+
+
+def move_blob(spooled, storage_path):
+    """Rename the staged file of ``spooled`` to ``storage_path`` under STORAGE_DIR."""
+    path = local_path(storage_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(spooled.path, path)
+    return storage_path
+
+
+def release_blob(conn, sha256):
+    """Drop one reference to a blob, deleting it once unreferenced.
+
+    Returns the storage_path of a deleted on-disk blob (to be removed with
+    removing() around the commit), or None.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE BLOBS SET refcount = refcount - 1 WHERE sha256 = %s RETURNING refcount, storage_path",
+        (sha256,)
+    )
+    row = cursor.fetchone()
+    if row is None or row[0] > 0:
+        return None
+    # BLOB_CHUNKS rows go with it via ON DELETE CASCADE
+    cursor.execute("DELETE FROM BLOBS WHERE sha256 = %s", (sha256,))
+    return row[1]
+
+
+@contextmanager
+def removing(storage_paths):
+    """Remove local files only if the enclosed block (usually a commit) succeeds.
+
+    Files are first renamed aside, so a failed commit can put them back and
+    a concurrent upload of the same content cannot have its fresh copy
+    deleted from under it.
+    """
+    moved = []
+    for storage_path in storage_paths:
+        if not storage_path:
+            continue
+        path = local_path(storage_path)
+        try:
+            os.replace(path, path + ".trash")
+            moved.append(path)
+        except FileNotFoundError:
+            pass
+    try:
+        yield
+    except BaseException:
+        for path in moved:
+            os.replace(path + ".trash", path)
+        raise
+    for path in moved:
+        os.remove(path + ".trash")
+
+
+def remove_file(storage_path):
+    try:
+        os.remove(local_path(storage_path))
+    except FileNotFoundError:
+        pass
+
+
+def _iter_chunks(query, key, chunk_size, start, stop):
+    seq = start // chunk_size
+    last_seq = (stop - 1) // chunk_size
+    while seq <= last_seq:
+        batch_end = min(seq + config.DOWNLOAD_BATCH_CHUNKS - 1, last_seq)
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (key, seq, batch_end))
+            rows = cursor.fetchall()
+        if len(rows) != batch_end - seq + 1:
+            return  # the content was deleted while it was being downloaded
+        for row_seq, data in rows:
+            offset = row_seq * chunk_size
+            data = bytes(data)
+            yield data[max(start - offset, 0):stop - offset]
+        seq = batch_end + 1
+
+
+def iter_blob_chunks(sha256, chunk_size, start, stop):
+    """Yield bytes ``start``..``stop`` (exclusive) of a blob stored in BLOB_CHUNKS.
+
+    Chunks are fetched DOWNLOAD_BATCH_CHUNKS at a time, each batch on a
+    briefly borrowed pooled connection, so slow clients do not pin a
+    connection for the whole transfer.
+    """
+    return _iter_chunks("""
+        SELECT seq, data FROM BLOB_CHUNKS
+        WHERE sha256 = %s AND seq BETWEEN %s AND %s
+        ORDER BY seq
+    """, sha256, chunk_size, start, stop)
+
+
+def iter_file_chunks(file_id, chunk_size, start, stop):
+    """Like iter_blob_chunks() for rows uploaded before blobs, kept in FILE_CHUNKS."""
+    return _iter_chunks("""
+        SELECT seq, data FROM FILE_CHUNKS
+        WHERE file_id = %s AND seq BETWEEN %s AND %s
+        ORDER BY seq
+    """, file_id, chunk_size, start, stop)
+
+
+def iter_inline(file_id, start, stop, chunk_size):
+    """Yield bytes ``start``..``stop`` of a legacy file whose content is in FILE_CONTENTS."""
+    position = start
+    while position < stop:
+        length = min(chunk_size, stop - position)
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            # substring() is 1-based
+            cursor.execute(
+                "SELECT substring(file_data FROM %s FOR %s) FROM FILE_CONTENTS WHERE file_id = %s",
+                (position + 1, length, file_id)
+            )
+            row = cursor.fetchone()
+        if not row or not row[0]:
+            return
+        yield bytes(row[0])
+        position += length
+
+
+def iter_local(storage_path, start, stop, chunk_size):
+    """Yield bytes ``start``..``stop`` of a file under STORAGE_DIR."""
+    with open(local_path(storage_path), "rb") as source:
+        source.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = source.read(min(chunk_size, remaining))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+
+def iter_blob(sha256, size, chunk_size, storage_path):
+    """Yield the ``size`` stored bytes of a blob, wherever it is kept.
+
+    For a compressed blob these are the compressed bytes; pass them through
+    compression.decompress() for the content.
+    """
+    if storage_path:
+        return iter_local(storage_path, 0, size, chunk_size)
+    if not size:
+        return iter(())
+    return iter_blob_chunks(sha256, chunk_size, 0, size)
@@ -0,0 +1,106 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+# Columns of the USER row kept in the cache; password_hash never is.
+USER_FIELDS = ("id", "email", "username", "created_at")
+
+
+def trim_user(user):
+    """Return the subset of a USER row that handlers are allowed to see."""
+    return {field: user[field] for field in USER_FIELDS if field in user}
+
+
+class TokenCache:
+    """TTL + LRU cache of verified tokens and the user rows they resolve to.
+
+    Entries are keyed by a SHA-256 digest of the raw token and expire at the
+    earlier of ``ttl`` seconds after insertion and the token's ``exp`` claim.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, claims, user)
+        self._by_user = {}  # user_id -> set of keys
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def _remove(self, key):
+        expires_at, claims, user = self._entries.pop(key)
+        keys = self._by_user.get(user["id"])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[user["id"]]
+
+    def get(self, token):
+        """Return ``(claims, user)`` for a cached token, or None."""
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, token, claims, user):
+        expires_at = time.time() + self.ttl
+        if "exp" in claims:
+            expires_at = min(expires_at, float(claims["exp"]))
+        if expires_at <= time.time() or self.max_entries <= 0:
+            return
+        user = trim_user(user)
+        key = self._key(token)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, claims, user)
+            self._by_user.setdefault(user["id"], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_user(self, user_id):
+        """Drop every cached token belonging to ``user_id``."""
+        with self._lock:
+            for key in list(self._by_user.get(user_id, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+cache = TokenCache(config.TOKEN_CACHE_SIZE, config.TOKEN_CACHE_TTL)